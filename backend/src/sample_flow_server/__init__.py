@@ -1,3 +1,11 @@
 __version__ = "0.0.1"
 
-from sample_flow_server.app import create_app
+
+def __getattr__(name: str):
+    # imported on first use, so that the gunicorn master process started by
+    # sample_flow_server doesn't import the app unless it is preloaded
+    if name == "create_app":
+        from sample_flow_server.app import create_app
+
+        return create_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
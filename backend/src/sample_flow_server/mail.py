@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+from typing import Optional, Dict
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from sample_flow_server.logger import get_logger
+
+logger = get_logger("SampleFlowServer")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # after failure_threshold consecutive failures the circuit opens and calls are
+    # rejected without being attempted for reset_timeout seconds. After that a single
+    # trial call is allowed: if it succeeds the circuit closes, otherwise it re-opens.
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_progress = False
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuit breaker {self.name} closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_progress or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(
+                        f"Circuit breaker {self.name} opened after {self._failures} failures"
+                    )
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+    def status(self) -> Dict:
+        with self._lock:
+            state = self._state()
+            return {
+                "state": state,
+                "degraded": state != "closed",
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+            }
+
+
+class EmailSender:
+    # sends email messages over a single SMTP connection, which is opened when
+    # the first message is sent and re-used for any further messages
+    def __init__(
+        self,
+        server_address: str,
+        timeout: float,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.server_address = server_address
+        self.timeout = timeout
+        self.circuit_breaker = circuit_breaker
+        self._smtp: Optional[smtplib.SMTP] = None
+
+    def send(self, email_message: EmailMessage) -> None:
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow():
+            raise CircuitOpenError(
+                f"Not sending email: {self.server_address} is unavailable"
+            )
+        try:
+            if self._smtp is None:
+                self._smtp = smtplib.SMTP(self.server_address, timeout=self.timeout)
+            self._smtp.send_message(email_message)
+        except Exception:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_failure()
+            # the connection may be in an unknown state: open a new one next time
+            self.close()
+            raise
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+
+    def close(self) -> None:
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+    def __enter__(self) -> EmailSender:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -1,15 +1,234 @@
 from __future__ import annotations
+from typing import Callable, Dict, Optional
+import importlib.util
+import os
 import click
-from sample_flow_server import create_app
+import flask
+from gunicorn.app.base import BaseApplication
+from sample_flow_server.logger import get_logger
+
+logger = get_logger("SampleFlowServer")
+
+WORKER_CLASSES = ["sync", "gthread", "gevent"]
+# rough upper bound on the resident memory of a single worker process
+WORKER_MEMORY = 256 * 1024 * 1024
+
+
+def _cpu_count() -> int:
+    # respects cpu affinity, e.g. when started with taskset
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _memory_bytes() -> Optional[int]:
+    # memory limit of the container if there is one, otherwise physical memory
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            return int(limit)
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_workers(cpu_count: int, memory_bytes: Optional[int]) -> int:
+    # the usual (2 x cores) + 1, limited to the number of workers that fit in memory
+    workers = 2 * cpu_count + 1
+    if memory_bytes is not None:
+        workers = min(workers, memory_bytes // WORKER_MEMORY)
+    return max(workers, 1)
+
+
+def app_factory(data_path: str, preload: bool) -> Callable[[], flask.Flask]:
+    # the app is only imported when it is created: without preload the master
+    # process never imports it, so workers started after a HUP signal load the
+    # currently installed code
+    def factory() -> flask.Flask:
+        from sample_flow_server.app import create_app
+
+        # with preload the email worker is started in each worker by post_fork,
+        # so that the master process only has a single thread and sends no emails
+        return create_app(data_path=data_path, email_worker=not preload)
+
+    return factory
+
+
+def post_fork(server, worker) -> None:
+    # with preload the app was created in the master process before forking:
+    # database connections must not be shared between processes, and each
+    # worker needs its own email worker thread
+    app = getattr(server.app, "callable", None)
+    if not isinstance(app, flask.Flask):
+        return
+    from sample_flow_server.model import db, start_email_worker
+
+    with app.app_context():
+        # close=False leaves the parent's connections open for the parent to use
+        db.engine.dispose(close=False)
+    if app.config["EMAIL_DELIVERY"] == "background":
+        start_email_worker(app)
+
+
+class GunicornApplication(BaseApplication):
+    # runs the flask app returned by app_factory with gunicorn
+    def __init__(self, app_factory: Callable[[], flask.Flask], options: Dict):
+        self.app_factory = app_factory
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+        self.cfg.set("post_fork", post_fork)
+
+    def load(self):
+        return self.app_factory()
+
+
+def gunicorn_options(
+    host: str,
+    port: int,
+    workers: int,
+    worker_class: str,
+    threads: int,
+    preload: bool,
+    max_requests: int,
+    max_requests_jitter: int,
+    timeout: int,
+    graceful_timeout: int,
+    pid: Optional[str],
+) -> Dict:
+    if worker_class == "gevent" and importlib.util.find_spec("gevent") is None:
+        raise click.BadParameter(
+            "gevent is not installed: pip install sample_flow_server[gevent]",
+            param_hint="--worker-class",
+        )
+    return {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "worker_class": worker_class,
+        # only used by gthread workers
+        "threads": threads if worker_class == "gthread" else 1,
+        "preload_app": preload,
+        "max_requests": max_requests,
+        "max_requests_jitter": max_requests_jitter,
+        "timeout": timeout,
+        "graceful_timeout": graceful_timeout,
+        "pidfile": pid,
+    }
 
 
 @click.command()
 @click.option("--host", default="localhost", show_default=True)
 @click.option("--port", default=8080, show_default=True)
 @click.option("--data-path", default=".", show_default=True)
-def main(host: str, port: int, data_path: str):
-    app = create_app(data_path=data_path)
-    app.run(host=host, port=port)
+@click.option(
+    "--dev",
+    is_flag=True,
+    help="Run the Flask development server instead of gunicorn.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=lambda: default_workers(_cpu_count(), _memory_bytes()),
+    show_default="2 x cores + 1, limited by memory",
+    help="Number of worker processes.",
+)
+@click.option(
+    "--worker-class",
+    type=click.Choice(WORKER_CLASSES),
+    default="gthread",
+    show_default=True,
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Threads per worker for the gthread worker class.",
+)
+@click.option(
+    "--preload/--no-preload",
+    default=False,
+    show_default=True,
+    help="Create the app once in the master process before forking the workers. "
+    "Uses less memory, but a HUP signal then doesn't reload the code.",
+)
+@click.option(
+    "--max-requests",
+    type=click.IntRange(min=0),
+    default=1000,
+    show_default=True,
+    help="Restart a worker after this many requests, 0 to disable.",
+)
+@click.option(
+    "--max-requests-jitter",
+    type=click.IntRange(min=0),
+    default=100,
+    show_default=True,
+    help="Add up to this many requests to max-requests, so workers don't all restart at once.",
+)
+@click.option(
+    "--timeout",
+    type=click.IntRange(min=0),
+    default=120,
+    show_default=True,
+    help="Restart a worker that is silent for this many seconds.",
+)
+@click.option(
+    "--graceful-timeout",
+    type=click.IntRange(min=0),
+    default=30,
+    show_default=True,
+    help="Seconds a worker has to finish its requests when restarted or stopped.",
+)
+@click.option(
+    "--pid",
+    default=None,
+    help="Write the pid of the master process to this file.",
+)
+def main(
+    host: str,
+    port: int,
+    data_path: str,
+    dev: bool,
+    workers: int,
+    worker_class: str,
+    threads: int,
+    preload: bool,
+    max_requests: int,
+    max_requests_jitter: int,
+    timeout: int,
+    graceful_timeout: int,
+    pid: Optional[str],
+):
+    if dev:
+        app_factory(data_path, preload=False)().run(host=host, port=port)
+        return
+    options = gunicorn_options(
+        host,
+        port,
+        workers,
+        worker_class,
+        threads,
+        preload,
+        max_requests,
+        max_requests_jitter,
+        timeout,
+        graceful_timeout,
+        pid,
+    )
+    logger.info(
+        f"Starting {workers} {worker_class} workers on {host}:{port} "
+        f"({'with' if preload else 'without'} preload)"
+    )
+    GunicornApplication(app_factory(data_path, preload), options).run()
 
 
 if __name__ == "__main__":
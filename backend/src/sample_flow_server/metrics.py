@@ -0,0 +1,373 @@
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Optional, Tuple
+import atexit
+import bisect
+import contextlib
+import fcntl
+import glob
+import json
+import math
+import os
+import pathlib
+import secrets
+import threading
+import time
+import flask
+from sample_flow_server.logger import get_logger
+
+logger = get_logger("SampleFlowServer")
+
+_DURATION_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name -> (type, help, histogram buckets)
+METRICS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "sample_flow_http_requests_total": (
+        "counter",
+        "HTTP requests by route, method and status code",
+        (),
+    ),
+    "sample_flow_http_request_duration_seconds": (
+        "histogram",
+        "HTTP request duration by route and method",
+        _DURATION_BUCKETS,
+    ),
+    "sample_flow_db_queries_total": (
+        "counter",
+        "SQL statements executed by route",
+        (),
+    ),
+    "sample_flow_db_queries_per_request": (
+        "histogram",
+        "SQL statements executed per HTTP request by route",
+        _COUNT_BUCKETS,
+    ),
+    "sample_flow_db_query_seconds_per_request": (
+        "histogram",
+        "Time spent executing SQL statements per HTTP request by route",
+        _DURATION_BUCKETS,
+    ),
+    "sample_flow_db_slow_queries_total": (
+        "counter",
+        "SQL statements slower than SQL_SLOW_QUERY_THRESHOLD by route",
+        (),
+    ),
+    "sample_flow_db_repeated_queries_total": (
+        "counter",
+        "Repeats of identical SQL statements within an HTTP request by route",
+        (),
+    ),
+    "sample_flow_smtp_send_duration_seconds": (
+        "histogram",
+        "Time taken to send an email to the SMTP server by result",
+        _DURATION_BUCKETS,
+    ),
+    "sample_flow_smtp_send_failures_total": (
+        "counter",
+        "Emails that could not be sent to the SMTP server",
+        (),
+    ),
+    "sample_flow_password_verify_duration_seconds": (
+        "histogram",
+        "Time taken to verify a password, including waiting for the hasher",
+        _DURATION_BUCKETS,
+    ),
+    "sample_flow_zip_build_duration_seconds": (
+        "histogram",
+        "Time taken to update the samples zip file",
+        _DURATION_BUCKETS,
+    ),
+}
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    # counters and histograms of this process, which are regularly written to
+    # a json file in path, so that the values from all gunicorn worker processes
+    # can be combined when they are collected
+    def __init__(self, path: str, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._filename = ""
+        self._counters: Dict[str, Dict[_Labels, float]] = {}
+        self._histograms: Dict[str, Dict[_Labels, List[float]]] = {}
+        self._last_flush = 0.0
+        atexit.register(self._flush_at_exit)
+
+    def _reset_if_forked(self) -> None:
+        # a forked worker starts with no values, and writes to its own file
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._filename = f"{self.path}/{self._pid}-{secrets.token_hex(4)}.json"
+            self._counters = {}
+            self._histograms = {}
+            self._last_flush = time.monotonic()
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._reset_if_forked()
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0.0) + value
+        self._maybe_flush()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        buckets = METRICS[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._reset_if_forked()
+            # counts for each bucket (non-cumulative) and +Inf, then sum
+            histogram = self._histograms.setdefault(name, {}).setdefault(
+                key, [0.0] * (len(buckets) + 2)
+            )
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._reset_if_forked()
+            self._last_flush = time.monotonic()
+            values = {
+                "counters": {
+                    name: [[dict(key), value] for key, value in counter.items()]
+                    for name, counter in self._counters.items()
+                },
+                "histograms": {
+                    name: [[dict(key), list(value)] for key, value in histogram.items()]
+                    for name, histogram in self._histograms.items()
+                },
+            }
+            filename = self._filename
+        with self._flush_lock:
+            _write_json(filename, values)
+
+    def _flush_at_exit(self) -> None:
+        if self._pid != os.getpid():
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            logger.warning(f"Failed to write metrics on exit: {e}")
+
+    def collect(self) -> str:
+        # returns the combined values from all processes in prometheus text format
+        self.flush()
+        with open(f"{self.path}/.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._archive_exited_processes()
+            values: Dict = {"counters": {}, "histograms": {}}
+            for filename in glob.glob(f"{self.path}/*.json"):
+                try:
+                    with open(filename) as f:
+                        _merge(values, json.load(f))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Ignoring metrics file {filename}: {e}")
+        return _prometheus_text(values)
+
+    def _archive_exited_processes(self) -> None:
+        # to avoid a growing number of files as workers are restarted, the values
+        # from processes that have exited are added to archive.json
+        archive_filename = f"{self.path}/archive.json"
+        exited_filenames = [
+            filename
+            for filename in glob.glob(f"{self.path}/*-*.json")
+            if not _process_exists(int(pathlib.Path(filename).name.split("-")[0]))
+        ]
+        if not exited_filenames:
+            return
+        archive: Dict = {"counters": {}, "histograms": {}}
+        for filename in [archive_filename] + exited_filenames:
+            with contextlib.suppress(OSError, ValueError):
+                with open(filename) as f:
+                    _merge(archive, json.load(f))
+        _write_json(archive_filename, _as_file_values(archive))
+        for filename in exited_filenames:
+            os.remove(filename)
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _write_json(filename: str, values: Dict) -> None:
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(values, f)
+    os.replace(tmp_filename, filename)
+
+
+def _merge(values: Dict, file_values: Dict) -> None:
+    for name, items in file_values.get("counters", {}).items():
+        if name not in METRICS:
+            continue
+        counter = values["counters"].setdefault(name, {})
+        for labels, value in items:
+            key = tuple(sorted(labels.items()))
+            counter[key] = counter.get(key, 0.0) + value
+    for name, items in file_values.get("histograms", {}).items():
+        if name not in METRICS:
+            continue
+        n_values = len(METRICS[name][2]) + 2
+        histogram = values["histograms"].setdefault(name, {})
+        for labels, value in items:
+            if len(value) != n_values:
+                # buckets have changed since this was written
+                continue
+            key = tuple(sorted(labels.items()))
+            total = histogram.setdefault(key, [0.0] * n_values)
+            for i, v in enumerate(value):
+                total[i] += v
+
+
+def _as_file_values(values: Dict) -> Dict:
+    return {
+        kind: {
+            name: [[dict(key), value] for key, value in items.items()]
+            for name, items in values[kind].items()
+        }
+        for kind in ["counters", "histograms"]
+    }
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels: _Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    if extra is not None:
+        labels = labels + (extra,)
+    if not labels:
+        return ""
+    escaped = [
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    ]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _prometheus_text(values: Dict) -> str:
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for key, value in sorted(values["counters"].get(name, {}).items()):
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+            continue
+        for key, value in sorted(values["histograms"].get(name, {}).items()):
+            cumulative = 0.0
+            for upper_bound, count in zip(buckets + (math.inf,), value[:-1]):
+                cumulative += count
+                le = ("le", _format_value(upper_bound))
+                lines.append(
+                    f"{name}_bucket{_format_labels(key, le)} {_format_value(cumulative)}"
+                )
+            lines.append(f"{name}_sum{_format_labels(key)} {_format_value(value[-1])}")
+            lines.append(
+                f"{name}_count{_format_labels(key)} {_format_value(cumulative)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def _current_metrics() -> Optional[Metrics]:
+    if not flask.has_app_context():
+        return None
+    return flask.current_app.extensions.get("metrics")
+
+
+def inc(name: str, value: float = 1.0, **labels: str) -> None:
+    # increment a counter of the current app, if there is one
+    metrics = _current_metrics()
+    if metrics is not None:
+        metrics.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    # add a value to a histogram of the current app, if there is one
+    metrics = _current_metrics()
+    if metrics is not None:
+        metrics.observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels: str) -> Iterator[Dict[str, str]]:
+    # add the duration of the block to a histogram, the yielded labels can be
+    # modified inside the block
+    start = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def request_route() -> str:
+    # the url rule rather than the path, to limit the number of distinct labels
+    if flask.request.url_rule is None:
+        return "unmatched"
+    return flask.request.url_rule.rule
+
+
+def start_request() -> None:
+    flask.g.request_start_time = time.perf_counter()
+
+
+def end_request(status_code: int, sql_queries: List) -> None:
+    if "request_start_time" not in flask.g:
+        return
+    duration = time.perf_counter() - flask.g.pop("request_start_time")
+    route = request_route()
+    method = flask.request.method
+    inc(
+        "sample_flow_http_requests_total",
+        route=route,
+        method=method,
+        status=str(status_code),
+    )
+    observe(
+        "sample_flow_http_request_duration_seconds",
+        duration,
+        route=route,
+        method=method,
+    )
+    inc("sample_flow_db_queries_total", len(sql_queries), route=route)
+    observe("sample_flow_db_queries_per_request", len(sql_queries), route=route)
+    observe(
+        "sample_flow_db_query_seconds_per_request",
+        sum(query.duration for query in sql_queries),
+        route=route,
+    )
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from typing import Callable, Iterator, List, Tuple
+import contextlib
+import datetime
+import fcntl
+from dataclasses import dataclass
+from sqlalchemy.engine import Connection
+from sample_flow_server.logger import get_logger
+from sample_flow_server.model import db, Settings, Sample, default_settings_dict
+
+logger = get_logger("SampleFlowServer")
+
+# arbitrary key for the postgres advisory lock held while upgrading the db
+MIGRATION_LOCK_KEY = 5375810
+
+
+@dataclass
+class SchemaVersion(db.Model):
+    id: int = db.Column(db.Integer, primary_key=True)
+    version: int = db.Column(db.Integer, nullable=False)
+    datetime: datetime.datetime = db.Column(db.DateTime, nullable=False)
+
+
+def _migrate_pickled_settings(connection: Connection) -> None:
+    # settings were stored as a pickled dict in a single settings_dict column
+    inspector = db.inspect(connection)
+    if not inspector.has_table("settings"):
+        return
+    columns = [c["name"] for c in inspector.get_columns("settings")]
+    if "settings_dict" not in columns:
+        return
+    pickled_settings = db.Table(
+        "settings_pickled",
+        db.MetaData(),
+        db.Column("id", db.Integer, primary_key=True),
+        db.Column("datetime", db.DateTime, nullable=False),
+        db.Column("email", db.String(256), nullable=False),
+        db.Column("settings_dict", db.PickleType, nullable=False),
+    )
+    connection.execute(db.text("ALTER TABLE settings RENAME TO settings_pickled"))
+    Settings.__table__.create(connection)
+    for row in connection.execute(
+        db.select(pickled_settings).order_by(pickled_settings.c.id)
+    ):
+        # use default values for any missing keys
+        settings_dict = default_settings_dict()
+        settings_dict.update(row.settings_dict)
+        connection.execute(
+            db.insert(Settings.__table__).values(
+                id=row.id,
+                datetime=row.datetime,
+                email=row.email,
+                **{key: settings_dict[key] for key in default_settings_dict()},
+            )
+        )
+        logger.info(f"  - migrated settings {row.id}")
+    pickled_settings.drop(connection)
+
+
+def _add_sample_indexes(connection: Connection) -> None:
+    if not db.inspect(connection).has_table("sample"):
+        return
+    for index in Sample.__table__.indexes:
+        logger.info(f"  - creating index {index.name}")
+        index.create(connection, checkfirst=True)
+
+
+# list of (version, description, migration) in the order they should be applied.
+# new migrations should be appended to the end with the next version number.
+migrations: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Store settings in typed columns", _migrate_pickled_settings),
+    (2, "Add Sample indexes", _add_sample_indexes),
+]
+
+
+def latest_schema_version() -> int:
+    return migrations[-1][0]
+
+
+def get_schema_version() -> int:
+    version = db.session.execute(db.select(db.func.max(SchemaVersion.version)))
+    return version.scalar_one() or 0
+
+
+@contextlib.contextmanager
+def migration_lock() -> Iterator[None]:
+    # each worker process upgrades the db when it starts, so only one process
+    # at a time may check and apply migrations
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as connection:
+            connection.execute(
+                db.text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+            )
+            try:
+                yield
+            finally:
+                connection.execute(
+                    db.text("SELECT pg_advisory_unlock(:key)"),
+                    {"key": MIGRATION_LOCK_KEY},
+                )
+    elif db.engine.dialect.name == "sqlite" and db.engine.url.database not in [
+        None,
+        "",
+        ":memory:",
+    ]:
+        with open(f"{db.engine.url.database}.migration.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+    else:
+        yield
+
+
+def upgrade_db() -> None:
+    with migration_lock():
+        _upgrade_db()
+
+
+def _upgrade_db() -> None:
+    if not db.inspect(db.engine).get_table_names():
+        # new database: create all tables with the latest schema
+        db.create_all()
+        db.session.add(
+            SchemaVersion(
+                version=latest_schema_version(), datetime=datetime.datetime.today()
+            )
+        )
+        db.session.commit()
+        return
+    SchemaVersion.__table__.create(db.engine, checkfirst=True)
+    current_version = get_schema_version()
+    for version, description, migration in migrations:
+        if version > current_version:
+            logger.info(f"Applying db migration {version}: {description}")
+            with db.engine.begin() as connection:
+                migration(connection)
+                connection.execute(
+                    db.insert(SchemaVersion.__table__).values(
+                        version=version, datetime=datetime.datetime.today()
+                    )
+                )
+    # create any new tables that don't exist yet
+    db.create_all()
@@ -1,22 +1,39 @@
 from __future__ import annotations
 
 import logging
-from typing import Optional, Dict, Tuple, List
-import smtplib
+import os
+import io
+import hashlib
+import copy
+import math
+from typing import Optional, Dict, Tuple, List, Iterator
+import threading
+import time
+import concurrent.futures
 from email.message import EmailMessage
+from email import message_from_bytes
+from email.policy import default as default_email_policy
 import re
 import flask
 import zipfile
 import shutil
-import argon2
+import secrets
+import fcntl
 import tempfile
 import pathlib
 import datetime
 from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 from dataclasses import dataclass
 from sample_flow_server.logger import get_logger
+from sample_flow_server.mail import EmailSender, CircuitOpenError
+from sample_flow_server.passwords import PasswordHasherPool
+from sample_flow_server.cache import TTLCache
+from sample_flow_server import metrics
 from sample_flow_server.utils import get_primary_key
 from sample_flow_server.utils import get_start_of_week
 import csv
@@ -28,16 +45,58 @@ from sample_flow_server.utils import (
 )
 
 db = SQLAlchemy()
-ph = argon2.PasswordHasher()
 logger = get_logger("SampleFlowServer")
 
+SQLITE_JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+SQLITE_SYNCHRONOUS_MODES = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+
+def set_sqlite_pragmas(engine: sqlalchemy.Engine, pragmas: Dict[str, str]) -> None:
+    # pragmas are set on each new connection to the database
+    journal_mode = pragmas.get("journal_mode", "DELETE").upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f"Invalid SQLite journal_mode {journal_mode}")
+    synchronous = pragmas.get("synchronous", "FULL").upper()
+    if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid SQLite synchronous mode {synchronous}")
+    statements = []
+    # busy_timeout goes first, so that changing the journal_mode waits for
+    # other connections to release their locks instead of failing immediately
+    if "busy_timeout" in pragmas:
+        statements.append(f"PRAGMA busy_timeout={int(pragmas['busy_timeout'])}")
+    statements += [
+        f"PRAGMA journal_mode={journal_mode}",
+        f"PRAGMA synchronous={synchronous}",
+    ]
+    for key in ["mmap_size", "cache_size"]:
+        if key in pragmas:
+            statements.append(f"PRAGMA {key}={int(pragmas[key])}")
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
 
 @dataclass
 class Settings(db.Model):
     id: int = db.Column(db.Integer, primary_key=True)
     datetime: datetime.datetime = db.Column(db.DateTime, nullable=False)
     email: str = db.Column(db.String(256), nullable=False)
-    settings_dict: Dict = db.Column(db.PickleType, nullable=False)
+    plate_n_rows: int = db.Column(db.Integer, nullable=False)
+    plate_n_cols: int = db.Column(db.Integer, nullable=False)
+    running_options: List[str] = db.Column(db.JSON, nullable=False)
+    last_submission_day: int = db.Column(db.Integer, nullable=False)
+
+    def as_dict(self) -> Dict:
+        return {
+            "plate_n_rows": self.plate_n_rows,
+            "plate_n_cols": self.plate_n_cols,
+            "running_options": list(self.running_options),
+            "last_submission_day": self.last_submission_day,
+        }
 
 
 def default_settings_dict() -> Dict:
@@ -49,53 +108,127 @@ def default_settings_dict() -> Dict:
     }
 
 
+def _is_int_in_range(value, min_value: int, max_value: int) -> bool:
+    return (
+        isinstance(value, int)
+        and not isinstance(value, bool)
+        and min_value <= value <= max_value
+    )
+
+
+def _validate_settings_dict(settings_dict: Dict) -> Optional[str]:
+    for required_field in default_settings_dict():
+        if required_field not in settings_dict:
+            return f"Required field {required_field} missing"
+    # primary keys use a single letter for the plate row
+    if not _is_int_in_range(settings_dict["plate_n_rows"], 1, 26):
+        return "plate_n_rows must be an integer between 1 and 26"
+    if not _is_int_in_range(settings_dict["plate_n_cols"], 1, 99):
+        return "plate_n_cols must be an integer between 1 and 99"
+    if not _is_int_in_range(settings_dict["last_submission_day"], 1, 7):
+        return "last_submission_day must be an integer between 1 and 7"
+    running_options = settings_dict["running_options"]
+    if not isinstance(running_options, list) or not all(
+        isinstance(running_option, str) for running_option in running_options
+    ):
+        return "running_options must be a list of strings"
+    return None
+
+
+# in-memory copy of the current settings for each data path, together with the
+# id of the Settings row it was read from and the time it expires. The id of the
+# latest Settings row is also written to a version file in the data path, so that
+# all worker processes on this host can check if their cached copy is still valid
+# without querying the database. Changes made on other hosts that share the
+# database are only seen when the cached copy expires after SETTINGS_CACHE_TTL.
+_settings_cache: Dict[str, Tuple[int, Dict, float]] = {}
+
+
+def _settings_version_file() -> pathlib.Path:
+    data_path = flask.current_app.config["CIRCUITSEQ_DATA_PATH"]
+    return pathlib.Path(data_path) / "settings_version"
+
+
+def _read_settings_version() -> Optional[int]:
+    try:
+        return int(_settings_version_file().read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_settings_version(settings_id: int) -> None:
+    # settings ids only increase, so a newer version written by a concurrent
+    # call is never replaced by an older one
+    version_file = _settings_version_file()
+    with open(f"{version_file}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        current_version = _read_settings_version()
+        if current_version is not None and current_version >= settings_id:
+            return
+        tmp_file = version_file.with_name(f"{version_file.name}.{os.getpid()}.tmp")
+        tmp_file.write_text(str(settings_id))
+        os.replace(tmp_file, version_file)
+
+
+def _cache_settings(settings: Settings) -> Dict:
+    data_path = flask.current_app.config["CIRCUITSEQ_DATA_PATH"]
+    settings_dict = settings.as_dict()
+    expires = time.monotonic() + flask.current_app.config["SETTINGS_CACHE_TTL"]
+    _settings_cache[data_path] = (settings.id, settings_dict, expires)
+    _write_settings_version(settings.id)
+    return copy.deepcopy(settings_dict)
+
+
 def get_current_settings() -> Dict:
-    settings_tuple = db.session.execute(
-        db.select(Settings).order_by(db.desc(Settings.id))
-    ).first()
-    if settings_tuple is not None:
-        settings_dict = settings_tuple[0].settings_dict
-        for key, value in default_settings_dict().items():
-            # use default values for any missing keys
-            if key not in settings_dict:
-                settings_dict[key] = value
-        return settings_dict
+    data_path = flask.current_app.config["CIRCUITSEQ_DATA_PATH"]
+    cached_settings = _settings_cache.get(data_path)
+    if cached_settings is not None:
+        settings_id, settings_dict, expires = cached_settings
+        if time.monotonic() < expires and settings_id == _read_settings_version():
+            return copy.deepcopy(settings_dict)
+    settings = db.session.execute(
+        db.select(Settings).order_by(db.desc(Settings.id)).limit(1)
+    ).scalar_one_or_none()
+    if settings is not None:
+        return _cache_settings(settings)
     # no settings in db: create default settings and add to db
     settings = Settings(
         datetime=datetime.datetime.today(),
         email="default",
-        settings_dict=default_settings_dict(),
+        **default_settings_dict(),
     )
     db.session.add(settings)
     db.session.commit()
-    return settings.settings_dict
+    return _cache_settings(settings)
 
 
 def set_current_settings(email: str, settings_dict: Dict) -> Tuple[str, int]:
-    for required_field in default_settings_dict():
-        if required_field not in settings_dict:
-            return (
-                f"Required field {required_field} missing - settings not updated",
-                400,
-            )
+    error_message = _validate_settings_dict(settings_dict)
+    if error_message is not None:
+        return f"{error_message} - settings not updated", 400
     settings = Settings(
-        datetime=datetime.datetime.today(), email=email, settings_dict=settings_dict
+        datetime=datetime.datetime.today(),
+        email=email,
+        **{key: settings_dict[key] for key in default_settings_dict()},
     )
     db.session.add(settings)
     db.session.commit()
+    _cache_settings(settings)
     return f"Settings updated by {settings.email} at {settings.datetime}", 200
 
 
 @dataclass
 class Sample(db.Model):
+    # the (email, date) index is also used for queries that only filter on email
+    __table_args__ = (db.Index("ix_sample_email_date", "email", "date"),)
     id: int = db.Column(db.Integer, primary_key=True)
     email: str = db.Column(db.String(256), nullable=False)
     primary_key: str = db.Column(db.String(32), nullable=False, unique=True)
-    tube_primary_key: str = db.Column(db.String(32), nullable=False)
+    tube_primary_key: str = db.Column(db.String(32), nullable=False, index=True)
     name: str = db.Column(db.String(128), nullable=False)
     running_option: str = db.Column(db.String(128), nullable=False)
     concentration: int = db.Column(db.Integer, nullable=False)
-    date: datetime.date = db.Column(db.Date, nullable=False)
+    date: datetime.date = db.Column(db.Date, nullable=False, index=True)
     has_reference_seq_zip: bool = db.Column(db.Boolean, nullable=False)
     has_results_zip: bool = db.Column(db.Boolean, nullable=False)
 
@@ -109,13 +242,53 @@ class Sample(db.Model):
         return f"{_get_basepath(self.date)}/inputs/references/{self.primary_key}_{self.name}.zip"
 
 
-def _samples_this_week(current_date: datetime.date):
+@dataclass
+class WellAllocation(db.Model):
+    # one row for each plate well reserved for a sample in a given week: the
+    # unique constraint ensures each well can only be reserved once, even if
+    # multiple worker processes try to reserve the same well at the same time
+    __table_args__ = (db.UniqueConstraint("year", "week", "plate", "well"),)
+    id: int = db.Column(db.Integer, primary_key=True)
+    year: int = db.Column(db.Integer, nullable=False)
+    week: int = db.Column(db.Integer, nullable=False)
+    # there is currently a single plate per week
+    plate: int = db.Column(db.Integer, nullable=False, default=1)
+    well: str = db.Column(db.String(8), nullable=False)
+    datetime: datetime.datetime = db.Column(db.DateTime, nullable=False)
+
+
+def _reserve_well(year: int, week: int, key: str) -> bool:
+    well = key.split("_")[-1]
+    db.session.add(
+        WellAllocation(
+            year=year,
+            week=week,
+            plate=1,
+            well=well,
+            datetime=datetime.datetime.today(),
+        )
+    )
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        logger.info(f"  -> well {well} already reserved for week {year}_{week}")
+        return False
+    return True
+
+
+def _this_week(current_date: datetime.date):
     start_of_week = get_start_of_week(current_date)
+    return db.and_(
+        Sample.date >= start_of_week,
+        Sample.date < start_of_week + datetime.timedelta(weeks=1),
+    )
+
+
+def _samples_this_week(current_date: datetime.date):
     return (
         db.session.execute(
-            db.select(Sample)
-            .filter(Sample.date >= start_of_week)
-            .filter(Sample.date < start_of_week + datetime.timedelta(weeks=1))
+            db.select(Sample).filter(_this_week(current_date)).order_by(Sample.id)
         )
         .scalars()
         .all()
@@ -123,19 +296,16 @@ def _samples_this_week(current_date: datetime.date):
 
 
 def _count_samples_this_week(current_date: datetime.date) -> int:
-    return len(_samples_this_week(current_date))
+    return db.session.execute(
+        db.select(db.func.count(Sample.id)).filter(_this_week(current_date))
+    ).scalar_one()
 
 
-def remaining_samples_this_week(
-    current_date: Optional[datetime.date] = None,
-) -> Dict:
-    if current_date is None:
-        current_date = datetime.date.today()
-    settings = get_current_settings()
+def _remaining_samples(current_date: datetime.date, settings: Dict, count: int) -> Dict:
     year, week, day = current_date.isocalendar()
     message = ""
     max_samples = settings["plate_n_rows"] * settings["plate_n_cols"]
-    remaining = max_samples - _count_samples_this_week(current_date)
+    remaining = max(max_samples - count, 0)
     if day > settings["last_submission_day"]:
         remaining = 0
         message = "Sample submission is closed for this week."
@@ -144,65 +314,229 @@ def remaining_samples_this_week(
     return {"remaining": remaining, "message": message}
 
 
+def remaining_samples_this_week(
+    current_date: Optional[datetime.date] = None,
+) -> Dict:
+    if current_date is None:
+        current_date = datetime.date.today()
+    return _remaining_samples(
+        current_date, get_current_settings(), _count_samples_this_week(current_date)
+    )
+
+
 def _get_basepath(current_date: datetime.date) -> str:
     year, week, _ = current_date.isocalendar()
     data_path = flask.current_app.config["CIRCUITSEQ_DATA_PATH"]
     return f"{data_path}/{year}/{week}"
 
 
+def _samples_tsv_this_week(current_date: datetime.date) -> str:
+    tsv = io.StringIO(newline="")
+    writer = csv.writer(tsv, delimiter="\t", lineterminator="\n")
+    columns = [
+        "date",
+        "primary_key",
+        "tube_primary_key",
+        "email",
+        "name",
+        "running_option",
+        "concentration",
+    ]
+    writer.writerow(columns)
+    for sample in _samples_this_week(current_date):
+        logger.info(f"  - {sample.primary_key}")
+        writer.writerow([getattr(sample, column) for column in columns])
+    return tsv.getvalue()
+
+
 def _write_samples_as_tsv_this_week(current_date: datetime.date) -> None:
-    filename = f"{_get_basepath(current_date)}/inputs/samples.tsv"
+    filename = pathlib.Path(f"{_get_basepath(current_date)}/inputs/samples.tsv")
     logger.info(f"Generating {filename}")
+    tsv = _samples_tsv_this_week(current_date)
+    if filename.is_file() and filename.read_text() == tsv:
+        # leave the file untouched so its modification time is unchanged
+        logger.info(f"  -> {filename} is unchanged")
+        return
     with open(filename, "w", newline="") as tsv_file:
-        writer = csv.writer(tsv_file, delimiter="\t", lineterminator="\n")
-        columns = [
-            "date",
-            "primary_key",
-            "tube_primary_key",
-            "email",
-            "name",
-            "running_option",
-            "concentration",
-        ]
-        writer.writerow(columns)
-        for sample in _samples_this_week(current_date):
-            logger.info(f"  - {sample.primary_key}")
-            writer.writerow([getattr(sample, column) for column in columns])
+        tsv_file.write(tsv)
+
+
+def _samples_zip_members(inputs_dir: str) -> List[Tuple[pathlib.Path, str]]:
+    # (path, archive name) of all directories and files in the inputs dir
+    members = []
+    for dirpath, dirnames, filenames in os.walk(inputs_dir):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = pathlib.Path(dirpath) / name
+            members.append((path, path.relative_to(inputs_dir).as_posix()))
+    return members
+
+
+def _samples_zip_fingerprint(members: List[Tuple[pathlib.Path, str]]) -> bytes:
+    fingerprint = hashlib.sha256()
+    for path, arcname in members:
+        stat = path.stat()
+        fingerprint.update(f"{arcname}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return fingerprint.hexdigest().encode()
+
+
+def _zip_compress_type(path: pathlib.Path) -> int:
+    # reference sequences are already zip files: store them without re-compressing
+    if path.suffix == ".zip":
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
 
 
 def update_samples_zipfile(current_date: Optional[datetime.date] = None) -> str:
+    with metrics.timed("sample_flow_zip_build_duration_seconds"):
+        return _update_samples_zipfile(current_date)
+
+
+def _update_samples_zipfile(current_date: Optional[datetime.date] = None) -> str:
     if current_date is None:
         current_date = datetime.date.today()
     base_path = _get_basepath(current_date)
     inputs_dir = f"{base_path}/inputs"
     pathlib.Path(inputs_dir).mkdir(parents=True, exist_ok=True)
     _write_samples_as_tsv_this_week(current_date)
+    members = _samples_zip_members(inputs_dir)
+    fingerprint = _samples_zip_fingerprint(members)
+    zip_filename = f"{base_path}/samples.zip"
+    try:
+        with zipfile.ZipFile(zip_filename) as existing_zip_file:
+            if existing_zip_file.comment == fingerprint:
+                logger.info(f"  -> inputs unchanged, re-using {zip_filename}")
+                return zip_filename
+    except (OSError, zipfile.BadZipFile):
+        pass
     logger.info(f"Creating zip file of {inputs_dir}..")
-    zip_filename = shutil.make_archive(
-        base_name=f"{base_path}/samples",
-        format="zip",
-        root_dir=f"{base_path}/inputs",
-    )
+    # write to a temporary file first so a concurrent download of the
+    # existing zip file is not affected
+    tmp_zip_filename = f"{zip_filename}.{os.getpid()}.tmp"
+    with zipfile.ZipFile(tmp_zip_filename, "w") as zip_file:
+        for path, arcname in members:
+            zip_file.write(path, arcname, compress_type=_zip_compress_type(path))
+        zip_file.comment = fingerprint
+    os.replace(tmp_zip_filename, zip_filename)
     logger.info(f"  -> created zip file {zip_filename}")
     return zip_filename
 
 
-def get_samples(email: Optional[str] = None) -> Dict[str, List[Sample]]:
+class _ZipStream(io.RawIOBase):
+    # non-seekable output stream that keeps the bytes written by ZipFile until they are read
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def read_written(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_samples_zipfile(
+    current_date: Optional[datetime.date] = None, chunk_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    # yields the same contents as update_samples_zipfile, as the zip file is generated
+    if current_date is None:
+        current_date = datetime.date.today()
+    inputs_dir = f"{_get_basepath(current_date)}/inputs"
+    logger.info(f"Streaming zip file of {inputs_dir}..")
+    members = [
+        (path, arcname)
+        for path, arcname in _samples_zip_members(inputs_dir)
+        if arcname != "samples.tsv"
+    ]
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w") as zip_file:
+        zip_file.writestr(
+            "samples.tsv",
+            _samples_tsv_this_week(current_date),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        yield stream.read_written()
+        for path, arcname in members:
+            zip_info = zipfile.ZipInfo.from_file(path, arcname)
+            if zip_info.is_dir():
+                zip_file.writestr(zip_info, b"")
+                continue
+            zip_info.compress_type = _zip_compress_type(path)
+            with open(path, "rb") as src, zip_file.open(zip_info, "w") as dest:
+                while chunk := src.read(chunk_size):
+                    dest.write(chunk)
+                    yield stream.read_written()
+            yield stream.read_written()
+    yield stream.read_written()
+    logger.info(f"  -> streamed zip file of {inputs_dir}")
+
+
+DEFAULT_SAMPLES_PAGE_SIZE = 100
+MAX_SAMPLES_PAGE_SIZE = 1000
+
+
+def encode_samples_cursor(sample: Sample) -> str:
+    return f"{sample.date.isoformat()}_{sample.id}"
+
+
+def decode_samples_cursor(cursor: str) -> Tuple[datetime.date, int]:
+    date, id = cursor.split("_")
+    return datetime.date.fromisoformat(date), int(id)
+
+
+def get_samples(
+    email: Optional[str] = None,
+    from_date: Optional[datetime.date] = None,
+    to_date: Optional[datetime.date] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_SAMPLES_PAGE_SIZE,
+) -> Dict:
+    # this week's samples are all returned on the first page, previous samples are
+    # returned in pages of at most `limit` samples, ordered by (date, id) descending.
+    # if there are more previous samples, `next_cursor` is the cursor for the next page.
     samples = {}
     start_of_week = get_start_of_week()
-    selected_samples = db.select(Sample).order_by(db.desc("date"))
+    selected_samples = db.select(Sample).order_by(
+        db.desc(Sample.date), db.desc(Sample.id)
+    )
     if email is not None:
         selected_samples = selected_samples.filter(Sample.email == email)
-    samples["current_samples"] = (
-        db.session.execute(selected_samples.filter(Sample.date >= start_of_week))
-        .scalars()
-        .all()
-    )
-    samples["previous_samples"] = (
-        db.session.execute(selected_samples.filter(Sample.date < start_of_week))
+    if from_date is not None:
+        selected_samples = selected_samples.filter(Sample.date >= from_date)
+    if to_date is not None:
+        selected_samples = selected_samples.filter(Sample.date <= to_date)
+    if cursor is None:
+        samples["current_samples"] = (
+            db.session.execute(selected_samples.filter(Sample.date >= start_of_week))
+            .scalars()
+            .all()
+        )
+    else:
+        samples["current_samples"] = []
+        cursor_date, cursor_id = decode_samples_cursor(cursor)
+        selected_samples = selected_samples.filter(
+            db.or_(
+                Sample.date < cursor_date,
+                db.and_(Sample.date == cursor_date, Sample.id < cursor_id),
+            )
+        )
+    previous_samples = (
+        db.session.execute(
+            selected_samples.filter(Sample.date < start_of_week).limit(limit + 1)
+        )
         .scalars()
         .all()
     )
+    samples["previous_samples"] = previous_samples[:limit]
+    samples["next_cursor"] = None
+    if len(previous_samples) > limit:
+        samples["next_cursor"] = encode_samples_cursor(previous_samples[limit - 1])
     return samples
 
 
@@ -217,14 +551,248 @@ def _wrap_email_message(email: str, message: str) -> str:
     return f"Dear {email},\n\n{message}\n\nBest wishes,\n\nSampleFlow Team.\nhttps://circuitseq.iwr.uni-heidelberg.de"
 
 
-def _send_email_message(email_message: EmailMessage) -> None:
-    postfix_server_address = "email:587"
-    with smtplib.SMTP(postfix_server_address) as s:
-        s.send_message(email_message)
+@dataclass
+class OutboxEmail(db.Model):
+    # email messages are added to the outbox in the same transaction as the
+    # changes that caused them, and are then sent by deliver_pending_emails,
+    # which deletes them once they have been sent
+    id: int = db.Column(db.Integer, primary_key=True)
+    created: datetime.datetime = db.Column(db.DateTime, nullable=False)
+    recipient: str = db.Column(db.Text, nullable=False)
+    subject: str = db.Column(db.Text, nullable=False)
+    message: bytes = db.Column(db.LargeBinary, nullable=False)
+    attempts: int = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt: datetime.datetime = db.Column(db.DateTime, nullable=False)
+    claimed_until: Optional[datetime.datetime] = db.Column(db.DateTime)
+    last_error: Optional[str] = db.Column(db.Text)
+
+    def email_message(self) -> EmailMessage:
+        return message_from_bytes(self.message, policy=default_email_policy)
+
+
+# give up on sending an email after this many failed attempts
+EMAIL_MAX_ATTEMPTS = 10
+# time a worker has to send a claimed email before another worker may claim it
+EMAIL_CLAIM_TIMEOUT = datetime.timedelta(minutes=5)
+# emails that could not be sent are deleted this long after they were created
+EMAIL_FAILED_RETENTION = datetime.timedelta(days=30)
+
+
+def _email_retry_delay(attempts: int) -> datetime.timedelta:
+    # exponential backoff: 1min, 2min, 4min, ... up to a maximum of 6 hours
+    return min(
+        datetime.timedelta(minutes=2 ** (attempts - 1)), datetime.timedelta(hours=6)
+    )
+
+
+def _queue_email_message(email_message: EmailMessage) -> None:
+    # the email is only sent once the current transaction is committed with _commit_emails
+    now = datetime.datetime.today()
+    db.session.add(
+        OutboxEmail(
+            created=now,
+            recipient=email_message["To"],
+            subject=email_message["Subject"],
+            message=email_message.as_bytes(),
+            attempts=0,
+            next_attempt=now,
+        )
+    )
+
+
+def _commit_emails() -> None:
+    db.session.commit()
+    if flask.current_app.config["EMAIL_DELIVERY"] == "immediate":
+        deliver_pending_emails()
+    else:
+        _email_worker_wakeup.set()
+
+
+def _send_email_message(sender: EmailSender, email_message: EmailMessage) -> None:
+    with metrics.timed(
+        "sample_flow_smtp_send_duration_seconds", result="sent"
+    ) as labels:
+        try:
+            sender.send(email_message)
+        except CircuitOpenError:
+            labels["result"] = "circuit_open"
+            raise
+        except Exception:
+            labels["result"] = "failed"
+            metrics.inc("sample_flow_smtp_send_failures_total")
+            raise
+
+
+def _claim_email(email_id: int, now: datetime.datetime) -> bool:
+    # atomically claim the email, so it is only sent by one worker
+    result = db.session.execute(
+        db.update(OutboxEmail)
+        .where(OutboxEmail.id == email_id)
+        .where(
+            db.or_(OutboxEmail.claimed_until.is_(None), OutboxEmail.claimed_until < now)
+        )
+        .values(claimed_until=now + EMAIL_CLAIM_TIMEOUT)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def _prune_failed_emails(now: datetime.datetime) -> None:
+    result = db.session.execute(
+        db.delete(OutboxEmail)
+        .where(OutboxEmail.attempts >= EMAIL_MAX_ATTEMPTS)
+        .where(OutboxEmail.created < now - EMAIL_FAILED_RETENTION)
+    )
+    db.session.commit()
+    if result.rowcount > 0:
+        logger.info(f"Deleted {result.rowcount} emails that could not be sent")
+
+
+def deliver_pending_emails(max_emails: int = 100) -> int:
+    now = datetime.datetime.today()
+    _prune_failed_emails(now)
+    pending_email_ids = (
+        db.session.execute(
+            db.select(OutboxEmail.id)
+            .filter(OutboxEmail.attempts < EMAIL_MAX_ATTEMPTS)
+            .filter(OutboxEmail.next_attempt <= now)
+            .filter(
+                db.or_(
+                    OutboxEmail.claimed_until.is_(None),
+                    OutboxEmail.claimed_until < now,
+                )
+            )
+            .order_by(OutboxEmail.id)
+            .limit(max_emails)
+        )
+        .scalars()
+        .all()
+    )
+    n_sent = 0
+    config = flask.current_app.config
+    with EmailSender(
+        config["EMAIL_SERVER_ADDRESS"],
+        config["EMAIL_SMTP_TIMEOUT"],
+        flask.current_app.extensions["email_circuit_breaker"],
+    ) as sender:
+        for email_id in pending_email_ids:
+            if not _claim_email(email_id, now):
+                continue
+            outbox_email = db.session.get(OutboxEmail, email_id)
+            try:
+                _send_email_message(sender, outbox_email.email_message())
+            except CircuitOpenError as e:
+                # email server is unavailable: leave remaining emails for later
+                logger.info(f"{e}: remaining emails will be sent later")
+                outbox_email.claimed_until = None
+                db.session.commit()
+                break
+            except Exception as e:
+                outbox_email.attempts += 1
+                outbox_email.last_error = str(e)
+                outbox_email.next_attempt = now + _email_retry_delay(
+                    outbox_email.attempts
+                )
+                logger.warning(
+                    f"Failed to send email {email_id} to {outbox_email.recipient} "
+                    f"(attempt {outbox_email.attempts}): {e}"
+                )
+                outbox_email.claimed_until = None
+                db.session.commit()
+                continue
+            # the message may contain attachments and password reset links,
+            # so it is not kept once it has been sent
+            db.session.delete(outbox_email)
+            db.session.commit()
+            n_sent += 1
+    return n_sent
+
+
+def email_status() -> Dict:
+    pending = db.session.execute(
+        db.select(db.func.count(OutboxEmail.id)).filter(
+            OutboxEmail.attempts < EMAIL_MAX_ATTEMPTS
+        )
+    ).scalar_one()
+    failed = db.session.execute(
+        db.select(db.func.count(OutboxEmail.id)).filter(
+            OutboxEmail.attempts >= EMAIL_MAX_ATTEMPTS
+        )
+    ).scalar_one()
+    return {
+        "circuit_breaker": flask.current_app.extensions[
+            "email_circuit_breaker"
+        ].status(),
+        "pending_emails": pending,
+        "failed_emails": failed,
+    }
+
+
+_email_worker_wakeup = threading.Event()
+# pid of the process that started the email worker for each data path
+_email_worker_pids: Dict[str, int] = {}
+
+
+def _email_worker(app: flask.Flask, interval: float, stop: threading.Event) -> None:
+    while not stop.is_set():
+        _email_worker_wakeup.wait(timeout=interval)
+        _email_worker_wakeup.clear()
+        with app.app_context():
+            try:
+                deliver_pending_emails()
+            except Exception as e:
+                logger.exception(f"Email worker failed to deliver emails: {e}")
+            finally:
+                db.session.remove()
+
+
+def start_email_worker(
+    app: flask.Flask, interval: float = 30.0
+) -> Optional[threading.Event]:
+    # threads are not copied to forked processes, so each process needs its own worker.
+    # returns an event that can be set to stop the worker
+    data_path = app.config["CIRCUITSEQ_DATA_PATH"]
+    if _email_worker_pids.get(data_path) == os.getpid():
+        return None
+    _email_worker_pids[data_path] = os.getpid()
+    logger.info(f"Starting email worker in process {os.getpid()}")
+    stop = threading.Event()
+    threading.Thread(
+        target=_email_worker,
+        args=(app, interval, stop),
+        name="email-worker",
+        daemon=True,
+    ).start()
+    return stop
+
+
+def _select_email_attachments(
+    result_zip_file: zipfile.ZipFile, result_files: List[str]
+) -> Tuple[List[str], List[str]]:
+    # each attachment is read into memory and the whole email is stored in the
+    # outbox, so the total uncompressed size of the attachments is limited
+    max_size = flask.current_app.config["EMAIL_MAX_ATTACHMENTS_SIZE"]
+    attachments = []
+    skipped_files = []
+    total_size = 0
+    for result_file in result_files:
+        file_size = result_zip_file.getinfo(result_file).file_size
+        if total_size + file_size > max_size:
+            logger.warning(
+                f"Not attaching {result_file} ({file_size} bytes): attachments would exceed {max_size} bytes"
+            )
+            skipped_files.append(pathlib.PurePosixPath(result_file).name)
+            continue
+        total_size += file_size
+        attachments.append(result_file)
+    return attachments, skipped_files
 
 
 def _send_result_email(
-    sample: Sample, success: bool, result_files: Optional[List[pathlib.Path]] = None
+    sample: Sample,
+    success: bool,
+    result_zip_file: Optional[zipfile.ZipFile] = None,
+    result_files: Optional[List[str]] = None,
 ) -> Tuple[str, int]:
     message_head = f"Your sample {sample.primary_key}_{sample.name} has been processed"
     if success:
@@ -241,6 +809,16 @@ def _send_result_email(
         logger.info(
             f"Sending {sample.primary_key} success={success} result email to {sample.email}"
         )
+        attachments = []
+        if success is True and result_zip_file is not None:
+            attachments, skipped_files = _select_email_attachments(
+                result_zip_file, result_files or []
+            )
+            if skipped_files:
+                message_body += (
+                    f"\n\nThe following files were too large to attach to this email, "
+                    f"but are included in the analysis data: {', '.join(skipped_files)}"
+                )
         msg = _new_email_message(sample.email)
         msg.set_content(
             _wrap_email_message(sample.email, f"{message_head}{message_body}")
@@ -248,29 +826,276 @@ def _send_result_email(
         msg[
             "Subject"
         ] = f"SampleFlow results for sample {sample.primary_key}_{sample.name}"
-        if success is True:
-            for result_file in result_files:
-                with open(result_file, "rb") as fp:
-                    result_file_data = fp.read()
-                msg.add_attachment(
-                    result_file_data,
-                    maintype="application",
-                    subtype="octet-stream",
-                    filename=result_file.name,
-                )
-        _send_email_message(msg)
+        for result_file in attachments:
+            msg.add_attachment(
+                result_zip_file.read(result_file),
+                maintype="application",
+                subtype="octet-stream",
+                filename=pathlib.PurePosixPath(result_file).name,
+            )
+        _queue_email_message(msg)
+        _commit_emails()
     except Exception as e:
-        logger.warning(f"  --> failed to send result email: {e}")
+        logger.warning(f"  --> failed to queue result email: {e}")
+        db.session.rollback()
         return (
             f"Failed to send results email for {sample.primary_key} to {sample.email}: {e}",
             400,
         )
     return (
-        f"Results email for {sample.primary_key} sent to {sample.email}",
+        f"Results email for {sample.primary_key} queued for {sample.email}",
         200,
     )
 
 
+# reference sequence and result zip files are stored once for each distinct
+# content in blobs/<sha256[:2]>/<sha256>, and the files in the weekly
+# directories are hardlinks to these blobs. Files that may be hardlinks must
+# not be modified in place: new contents are always written to a temporary
+# file which then replaces the hardlink.
+def _blobs_dir() -> pathlib.Path:
+    data_path = flask.current_app.config["CIRCUITSEQ_DATA_PATH"]
+    return pathlib.Path(data_path) / "blobs"
+
+
+def _new_blob_tmp_path() -> pathlib.Path:
+    # temporary files are created in the data path, so that they can be
+    # hardlinked into the blob store
+    tmp_dir = _blobs_dir() / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    return tmp_dir / secrets.token_hex(16)
+
+
+def _file_sha256(path: pathlib.Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _store_blob(tmp_path: pathlib.Path, dst: str | pathlib.Path) -> None:
+    # tmp_path is added to the blob store if there is no blob with the same
+    # contents, then dst is replaced with a hardlink to the blob
+    sha256 = _file_sha256(tmp_path)
+    blob_path = _blobs_dir() / sha256[:2] / sha256
+    try:
+        blob_path.parent.mkdir(exist_ok=True)
+        try:
+            os.link(tmp_path, blob_path)
+        except FileExistsError:
+            # a file with the same contents is already stored: use it instead
+            blob_link = _new_blob_tmp_path()
+            os.link(blob_path, blob_link)
+            os.replace(blob_link, tmp_path)
+    except OSError as e:
+        logger.warning(f"Failed to add {dst} to blob store: {e}")
+    os.replace(tmp_path, dst)
+
+
+# temporary files older than this were left behind by a failed request
+BLOB_TMP_EXPIRY = datetime.timedelta(days=1)
+
+
+def remove_unused_blobs() -> Dict[str, int]:
+    # a blob that is no longer linked from any weekly directory, e.g. because
+    # its result was replaced or an old week was deleted, only has one link left
+    expiry = time.time() - BLOB_TMP_EXPIRY.total_seconds()
+    removed = {"blobs": 0, "tmp_files": 0, "bytes": 0}
+    # leftover temporary files are removed first, as they may link to a blob
+    for tmp_path in (_blobs_dir() / "tmp").glob("*"):
+        try:
+            stat = tmp_path.stat()
+            if stat.st_mtime < expiry:
+                tmp_path.unlink()
+                removed["tmp_files"] += 1
+                if stat.st_nlink == 1:
+                    removed["bytes"] += stat.st_size
+        except OSError as e:
+            logger.warning(f"Failed to remove temporary file {tmp_path}: {e}")
+    for blob_path in _blobs_dir().glob("??/*"):
+        try:
+            stat = blob_path.stat()
+            if stat.st_nlink == 1:
+                blob_path.unlink()
+                removed["blobs"] += 1
+                removed["bytes"] += stat.st_size
+        except OSError as e:
+            logger.warning(f"Failed to remove blob {blob_path}: {e}")
+    logger.info(
+        f"Removed {removed['blobs']} unused blobs and {removed['tmp_files']} "
+        f"temporary files, freeing {removed['bytes']} bytes"
+    )
+    return removed
+
+
+def _link_file(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        logger.warning(f"Failed to link {src} to {dst}, copying instead: {e}")
+        shutil.copy(src, dst)
+
+
+def _write_reference_seq_zip(
+    zip_path: pathlib.Path, reference_sequence_files: List[pathlib.Path]
+) -> None:
+    # fixed timestamps and permissions, so that the same reference sequence
+    # files always result in the same zip file
+    with zipfile.ZipFile(zip_path, "w") as zip_file:
+        for reference_sequence_file in sorted(reference_sequence_files):
+            zip_info = zipfile.ZipInfo(reference_sequence_file.name)
+            zip_info.external_attr = 0o644 << 16
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            with open(reference_sequence_file, "rb") as src:
+                with zip_file.open(zip_info, "w") as dst:
+                    shutil.copyfileobj(src, dst)
+
+
+@dataclass
+class Upload(db.Model):
+    # a file uploaded in chunks: each chunk is appended to the file at
+    # offset, and the upload is complete once offset reaches length
+    id: str = db.Column(db.String(32), primary_key=True)
+    email: str = db.Column(db.String(256), nullable=False)
+    filename: str = db.Column(db.String(256), nullable=False)
+    length: int = db.Column(db.BigInteger, nullable=False)
+    offset: int = db.Column(db.BigInteger, nullable=False)
+    created: datetime.datetime = db.Column(db.DateTime, nullable=False)
+    # last time data was appended, used to expire abandoned uploads
+    updated: datetime.datetime = db.Column(db.DateTime, nullable=False)
+
+    def file_path(self) -> pathlib.Path:
+        return _uploads_dir() / self.id
+
+    def is_complete(self) -> bool:
+        return self.offset == self.length
+
+
+# uploads that have not been appended to or used within this time are removed
+UPLOAD_EXPIRY = datetime.timedelta(days=1)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _uploads_dir() -> pathlib.Path:
+    # uploads are stored in the data path so that completed uploads can be
+    # moved to their final location without copying them
+    data_path = flask.current_app.config["CIRCUITSEQ_DATA_PATH"]
+    return pathlib.Path(data_path) / "uploads"
+
+
+def _remove_expired_uploads(now: datetime.datetime) -> None:
+    expired_uploads = (
+        db.session.execute(
+            db.select(Upload).filter(Upload.updated < now - UPLOAD_EXPIRY)
+        )
+        .scalars()
+        .all()
+    )
+    for upload in expired_uploads:
+        try:
+            with open(upload.file_path(), "r+b") as f:
+                # a request that is still appending to the upload holds the lock
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                logger.info(f"Removing expired upload {upload.id} from {upload.email}")
+                upload.file_path().unlink()
+        except BlockingIOError:
+            continue
+        except FileNotFoundError:
+            pass
+        db.session.delete(upload)
+    db.session.commit()
+
+
+def create_upload(
+    email: str, filename: str, length: int, max_length: int
+) -> Tuple[Optional[Upload], str]:
+    now = datetime.datetime.today()
+    _remove_expired_uploads(now)
+    if not secure_filename(filename) or len(filename) > 256:
+        return None, "Invalid filename"
+    if length < 0 or length > max_length:
+        return None, f"Upload length must be between 0 and {max_length} bytes"
+    upload = Upload(
+        id=secrets.token_hex(16),
+        email=email,
+        filename=filename,
+        length=length,
+        offset=0,
+        created=now,
+        updated=now,
+    )
+    _uploads_dir().mkdir(parents=True, exist_ok=True)
+    upload.file_path().touch(exist_ok=False)
+    db.session.add(upload)
+    db.session.commit()
+    return upload, ""
+
+
+def get_upload(upload_id: str, email: str) -> Optional[Upload]:
+    return db.session.execute(
+        db.select(Upload).filter_by(id=upload_id, email=email)
+    ).scalar_one_or_none()
+
+
+def append_to_upload(upload: Upload, offset: int, stream) -> Tuple[str, int]:
+    if offset != upload.offset:
+        return f"Upload offset is {upload.offset}", 409
+    with open(upload.file_path(), "r+b") as f:
+        # the lock ensures only one request at a time appends to an upload
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return "Upload is being appended to by another request", 409
+        db.session.refresh(upload)
+        if offset != upload.offset:
+            return f"Upload offset is {upload.offset}", 409
+        f.seek(offset)
+        remaining = upload.length - offset
+        message, code = "Chunk appended", 200
+        try:
+            while remaining > 0:
+                chunk = stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        except Exception as e:
+            # keep the data received so far, the client can resume from there
+            logger.warning(f"Upload {upload.id} interrupted: {e}")
+            message, code = "Upload interrupted", 400
+        finally:
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+            upload.offset = f.tell()
+            upload.updated = datetime.datetime.today()
+            db.session.commit()
+    logger.info(f"Upload {upload.id} at offset {upload.offset}/{upload.length}")
+    return message, code
+
+
+@dataclass
+class _UploadedFile:
+    # a completed upload, used in place of a FileStorage
+    upload_id: str
+    path: pathlib.Path
+    filename: str
+
+    def save(self, dst: str) -> None:
+        # the upload is removed once its contents have been moved to dst
+        shutil.move(self.path, dst)
+        db.session.execute(db.delete(Upload).filter_by(id=self.upload_id))
+
+
+def get_uploaded_file(upload_id: str, email: str) -> Optional[_UploadedFile]:
+    upload = get_upload(upload_id, email)
+    if upload is None or not upload.is_complete():
+        return None
+    return _UploadedFile(upload.id, upload.file_path(), upload.filename)
+
+
 def _is_valid_filename(primary_key: str, filename: str) -> bool:
     segments = pathlib.Path(filename).name.split("_")
     if len(segments) < 3:
@@ -281,20 +1106,35 @@ def _is_valid_filename(primary_key: str, filename: str) -> bool:
     return primary_key == f"{yy}_{ww}_{nn}"
 
 
-def process_result(
-    primary_key: str, success: bool, result_zip_file: Optional[FileStorage]
-) -> Tuple[str, int]:
+def _primary_key_from_filename(filename: str) -> Optional[str]:
+    segments = pathlib.Path(filename).name.split("_")
+    primary_key = "_".join(segments[:3])
+    if not _is_valid_filename(primary_key, filename):
+        return None
+    return primary_key
+
+
+def _get_result_sample(primary_key: str) -> Optional[Sample]:
+    # results for a resubmitted sample belong to the sample with its tube key
     sample = db.session.execute(
         db.select(Sample).filter_by(primary_key=primary_key)
     ).scalar_one_or_none()
-    if sample is None:
-        logger.warning(f" --> Unknown primary key {primary_key}")
-        return f"Unknown primary key {primary_key}", 400
-    if sample.tube_primary_key != sample.primary_key:
+    if sample is not None and sample.tube_primary_key != sample.primary_key:
         logger.info(
             f"Tube key '{sample.tube_primary_key}' differs from primary key '{primary_key}' -> using tube key"
         )
-        return process_result(sample.tube_primary_key, success, result_zip_file)
+        return _get_result_sample(sample.tube_primary_key)
+    return sample
+
+
+def process_result(
+    primary_key: str, success: bool, result_zip_file: Optional[FileStorage]
+) -> Tuple[str, int]:
+    sample = _get_result_sample(primary_key)
+    if sample is None:
+        logger.warning(f" --> Unknown primary key {primary_key}")
+        return f"Unknown primary key {primary_key}", 400
+    primary_key = sample.primary_key
     if success is False:
         logger.info("Sending result failure message for {primary_key}")
         sample.has_results_zip = False
@@ -307,32 +1147,148 @@ def process_result(
         f"Processing zip file {result_zip_file} for {primary_key} --> {sample.results_file_path()}"
     )
     pathlib.Path(sample.results_dir()).mkdir(parents=True, exist_ok=True)
-    result_zip_file.save(sample.results_file_path())
+    tmp_path = _new_blob_tmp_path()
+    result_zip_file.save(tmp_path)
+    _store_blob(tmp_path, sample.results_file_path())
     sample.has_results_zip = True
     db.session.commit()
-    result_files = []
-    with tempfile.TemporaryDirectory() as tmp_dir:
+    # files listed in email.txt are attached to the email directly from the zip file
+    try:
+        zip_file = zipfile.ZipFile(sample.results_file_path())
+    except Exception as e:
+        logger.warning(f"Failed to open zip file: {e}")
+        email_message, _ = _send_result_email(sample, success)
+        return f"Results file saved, {email_message}", 200
+    with zip_file:
+        result_files = []
         try:
-            zip_file = zipfile.ZipFile(sample.results_file_path())
-            zip_file.extract("email.txt", tmp_dir)
-            with open(f"{tmp_dir}/email.txt") as f:
-                files_to_email = f.readlines()
+            files_to_email = zip_file.read("email.txt").decode().splitlines()
+            zip_file_contents = set(zip_file.namelist())
             for file_to_email in files_to_email:
                 file_to_email = file_to_email.strip()
-                logger.info(f"Trying to extract {file_to_email} from zipfile")
-                try:
-                    result_files.append(
-                        pathlib.Path(zip_file.extract(file_to_email, tmp_dir))
-                    )
-                    logger.info(f"--> extracted {file_to_email}")
-                except Exception as e:
-                    logging.warning(f"Failed to extract file {file_to_email}: {e}")
+                if file_to_email in zip_file_contents:
+                    logger.info(f"--> attaching {file_to_email}")
+                    result_files.append(file_to_email)
+                else:
+                    logger.warning(f"File {file_to_email} not found in zip file")
         except Exception as e:
             logger.warning(f"Failed to process zip file: {e}")
-        email_message, _ = _send_result_email(sample, success, result_files)
+        email_message, _ = _send_result_email(sample, success, zip_file, result_files)
     return f"Results file saved, {email_message}", 200
 
 
+@dataclass
+class _ArchiveMember:
+    # a result zip file inside an uploaded archive of result zip files
+    archive_path: str
+    name: str
+
+    def save(self, dst: str) -> None:
+        with zipfile.ZipFile(self.archive_path) as archive:
+            with archive.open(self.name) as src, open(dst, "wb") as f:
+                shutil.copyfileobj(src, f)
+
+
+def _process_results(
+    results: Dict[str, Optional[FileStorage | _ArchiveMember]], max_workers: int
+) -> Dict[str, Dict]:
+    report = {}
+    results_by_sample = {}
+    for primary_key, result_zip_file in results.items():
+        sample = _get_result_sample(primary_key)
+        if sample is None:
+            report[primary_key] = {
+                "message": f"Unknown primary key {primary_key}",
+                "code": 400,
+            }
+        elif sample.primary_key in results_by_sample:
+            report[primary_key] = {
+                "message": f"Multiple results for sample {sample.primary_key}",
+                "code": 400,
+            }
+        else:
+            results_by_sample[sample.primary_key] = (primary_key, result_zip_file)
+    app = flask.current_app._get_current_object()
+
+    def _process_result(primary_key: str, result_zip_file) -> Tuple[str, int]:
+        with app.app_context():
+            return process_result(
+                primary_key, result_zip_file is not None, result_zip_file
+            )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            primary_key: executor.submit(_process_result, primary_key, result_zip_file)
+            for primary_key, result_zip_file in results_by_sample.values()
+        }
+        for primary_key, future in futures.items():
+            try:
+                message, code = future.result()
+            except Exception as e:
+                logger.exception(e)
+                message, code = f"Failed to process result for {primary_key}: {e}", 400
+            report[primary_key] = {"message": message, "code": code}
+    return report
+
+
+def process_results(
+    result_zip_files: List[FileStorage],
+    archive: Optional[FileStorage],
+    failed_primary_keys: List[str],
+    max_workers: int = 4,
+) -> Dict[str, Dict]:
+    # results are mapped to samples using the primary key at the start of each filename:
+    # result_zip_files are individual result zip files, archive is a zip of result zip files
+    results = {primary_key: None for primary_key in failed_primary_keys}
+    report = {}
+
+    def _add_result(filename: str, result_zip_file) -> None:
+        primary_key = _primary_key_from_filename(filename)
+        if primary_key is None:
+            logger.warning(f" --> No primary key in filename '{filename}'")
+            report[filename] = {
+                "message": f"Filename '{filename}' does not start with a primary key",
+                "code": 400,
+            }
+        elif primary_key in results:
+            report[filename] = {
+                "message": f"Multiple results for primary key {primary_key}",
+                "code": 400,
+            }
+        else:
+            results[primary_key] = result_zip_file
+
+    for result_zip_file in result_zip_files:
+        _add_result(result_zip_file.filename, result_zip_file)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if archive is not None:
+            archive_path = f"{tmp_dir}/results.zip"
+            archive.save(archive_path)
+            try:
+                with zipfile.ZipFile(archive_path) as archive_zip_file:
+                    names = [
+                        info.filename
+                        for info in archive_zip_file.infolist()
+                        if not info.is_dir()
+                    ]
+            except zipfile.BadZipFile as e:
+                logger.warning(f" --> Invalid results archive: {e}")
+                names = []
+                report[archive.filename] = {
+                    "message": f"Invalid results archive: {e}",
+                    "code": 400,
+                }
+            for name in names:
+                _add_result(name, _ArchiveMember(archive_path, name))
+        logger.info(f"Processing {len(results)} results with {max_workers} workers")
+        report.update(_process_results(results, max_workers))
+    return report
+
+
+def password_hasher() -> PasswordHasherPool:
+    return flask.current_app.extensions["password_hasher"]
+
+
 @dataclass
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -342,7 +1298,7 @@ class User(db.Model):
     is_admin = db.Column(db.Boolean, nullable=False)
 
     def set_password_nocheck(self, new_password: str):
-        self.password_hash = ph.hash(new_password)
+        self.password_hash = password_hasher().hash(new_password)
         db.session.commit()
 
     def set_password(self, current_password: str, new_password: str) -> bool:
@@ -352,12 +1308,12 @@ class User(db.Model):
         return False
 
     def check_password(self, password: str) -> bool:
-        try:
-            ph.verify(self.password_hash, password)
-        except argon2.exceptions.VerificationError:
+        with metrics.timed("sample_flow_password_verify_duration_seconds"):
+            verified = password_hasher().verify(self.password_hash, password)
+        if not verified:
             return False
-        if ph.check_needs_rehash(self.password_hash):
-            self.password_hash = ph.hash(password)
+        if password_hasher().check_needs_rehash(self.password_hash):
+            self.password_hash = password_hasher().hash(password)
             db.session.commit()
         return True
 
@@ -370,6 +1326,133 @@ class User(db.Model):
         }
 
 
+def _user_cache() -> TTLCache:
+    return flask.current_app.extensions["user_cache"]
+
+
+# only identity and authorisation columns are cached: the password hash is always
+# read from the database, as changes made by other processes may still be cached
+_CACHED_USER_COLUMNS = ["id", "email", "activated", "is_admin"]
+
+
+def get_user(user_id: int, use_cache: bool = True) -> Optional[User]:
+    # recently used users are cached, so that authenticated requests don't
+    # need to query the database for the current user
+    user_data = _user_cache().get(user_id) if use_cache else None
+    if user_data is not None:
+        user = User(**user_data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = db.session.execute(
+        db.select(User)
+        .filter(User.id == user_id)
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+    if user is not None:
+        _user_cache().set(
+            user_id, {key: getattr(user, key) for key in _CACHED_USER_COLUMNS}
+        )
+    return user
+
+
+@sqlalchemy.event.listens_for(User, "after_update")
+@sqlalchemy.event.listens_for(User, "after_delete")
+def _invalidate_cached_user(_mapper, _connection, user: User) -> None:
+    # users modified by other processes may be cached until the cache ttl expires
+    _user_cache().invalidate(user.id)
+
+
+@dataclass
+class LoginAttempt(db.Model):
+    # each login attempt is recorded as a failure before the password is
+    # verified, then marked as successful if the password is correct, so that
+    # concurrent attempts are also counted by the login throttle
+    id: int = db.Column(db.Integer, primary_key=True)
+    datetime: datetime.datetime = db.Column(db.DateTime, nullable=False, index=True)
+    email: str = db.Column(db.String(256), nullable=False, index=True)
+    ip: str = db.Column(db.String(64), nullable=False, index=True)
+    success: bool = db.Column(db.Boolean, nullable=False)
+
+
+def _login_throttle_limits() -> List[Tuple[str, int]]:
+    config = flask.current_app.config
+    return [
+        ("email", config["LOGIN_MAX_FAILURES_PER_EMAIL"]),
+        ("ip", config["LOGIN_MAX_FAILURES_PER_IP"]),
+    ]
+
+
+def _recent_login_failures(since: datetime.datetime):
+    return (
+        db.select(LoginAttempt.id)
+        .filter(LoginAttempt.success.is_(False))
+        .filter(LoginAttempt.datetime > since)
+    )
+
+
+def _login_throttle_window() -> datetime.timedelta:
+    return datetime.timedelta(seconds=flask.current_app.config["LOGIN_THROTTLE_WINDOW"])
+
+
+def start_login_attempt(email: str, ip: str) -> Tuple[Optional[LoginAttempt], int]:
+    # returns the new login attempt, or None and the number of seconds until
+    # another attempt is allowed if there are too many recent failed attempts
+    # for this email address or ip address
+    now = datetime.datetime.today()
+    window = _login_throttle_window()
+    retry_after = 0
+    values = {"email": email[:256], "ip": ip[:64]}
+    for key, max_failures in _login_throttle_limits():
+        failures = (
+            db.session.execute(
+                _recent_login_failures(now - window)
+                .with_only_columns(LoginAttempt.datetime)
+                .filter(getattr(LoginAttempt, key) == values[key])
+                .order_by(LoginAttempt.datetime)
+            )
+            .scalars()
+            .all()
+        )
+        if len(failures) >= max_failures:
+            # sliding window: wait until enough of these failures have expired
+            expires = failures[len(failures) - max_failures] + window
+            retry_after = max(
+                retry_after, math.ceil((expires - now).total_seconds()), 1
+            )
+    if retry_after > 0:
+        logger.info(f"  -> login throttled for {email} from {ip}")
+        return None, retry_after
+    db.session.execute(
+        db.delete(LoginAttempt).filter(LoginAttempt.datetime <= now - window)
+    )
+    login_attempt = LoginAttempt(
+        datetime=now, email=email[:256], ip=ip[:64], success=False
+    )
+    db.session.add(login_attempt)
+    db.session.commit()
+    return login_attempt, 0
+
+
+def login_throttle_status() -> Dict:
+    since = datetime.datetime.today() - _login_throttle_window()
+    status = {
+        "window": flask.current_app.config["LOGIN_THROTTLE_WINDOW"],
+    }
+    for key, max_failures in _login_throttle_limits():
+        column = getattr(LoginAttempt, key)
+        failures = db.session.execute(
+            _recent_login_failures(since)
+            .with_only_columns(column, db.func.count(LoginAttempt.id))
+            .group_by(column)
+        ).all()
+        status[f"max_failures_per_{key}"] = max_failures
+        status[f"failures_by_{key}"] = {value: count for value, count in failures}
+        status[f"throttled_{key}s"] = sorted(
+            value for value, count in failures if count >= max_failures
+        )
+    return status
+
+
 def is_valid_email(email: str) -> bool:
     return re.match(r"\S+@((\S*heidelberg)|embl|dkfz)\.de$", email) is not None
 
@@ -392,7 +1475,7 @@ def _send_activation_email(email: str):
     )
     msg.set_content(_wrap_email_message(email, msg_body))
     msg["Subject"] = "SampleFlow account activation"
-    _send_email_message(msg)
+    _queue_email_message(msg)
 
 
 def send_password_reset_email(email: str) -> Tuple[str, int]:
@@ -421,7 +1504,8 @@ def send_password_reset_email(email: str) -> Tuple[str, int]:
         )
     msg.set_content(_wrap_email_message(email, msg_body))
     msg["Subject"] = "SampleFlow password reset"
-    _send_email_message(msg)
+    _queue_email_message(msg)
+    _commit_emails()
     return f"Sent password reset email to '{email}'", 200
 
 
@@ -443,23 +1527,22 @@ def add_new_user(email: str, password: str, is_admin: bool) -> Tuple[str, int]:
             "This email address is already in use",
             400,
         )
-    try:
-        _send_activation_email(email)
-    except Exception as e:
-        logger.warning(f"Send activation email failed: {e}")
-        return "Failed to send activation email", 400
+    # raises PasswordHasherBusyError if the server is too busy
+    password_hash = password_hasher().hash(password)
     try:
         db.session.add(
             User(
                 email=email,
-                password_hash=ph.hash(password),
+                password_hash=password_hash,
                 activated=False,
                 is_admin=is_admin,
             )
         )
-        db.session.commit()
+        _send_activation_email(email)
+        _commit_emails()
     except Exception as e:
         logger.warning(f"Error adding user to db: {e}")
+        db.session.rollback()
         return "Failed to create new user", 400
     return (
         f"Successful signup for {email}. To activate your account, please click on the link in the activation email from no-reply@circuitseq.iwr.uni-heidelberg.de sent to this email address",
@@ -518,17 +1601,22 @@ def _get_new_key(today: datetime) -> Tuple[Optional[str], str]:
     year, week, day = today.isocalendar()
     count = _count_samples_this_week(today)
     settings = get_current_settings()
-    remaining_samples = remaining_samples_this_week()
+    remaining_samples = _remaining_samples(today, settings, count)
     if remaining_samples["remaining"] == 0:
         return None, remaining_samples["message"]
-    key = get_primary_key(
-        year=year,
-        week=week,
-        current_count=count,
-        n_rows=settings["plate_n_rows"],
-        n_cols=settings["plate_n_cols"],
-    )
-    return key, ""
+    # reserve the first free well, starting from the current number of samples.
+    # if a concurrent request has already reserved it, try the next one.
+    for current_count in range(count, count + remaining_samples["remaining"]):
+        key = get_primary_key(
+            year=year,
+            week=week,
+            current_count=current_count,
+            n_rows=settings["plate_n_rows"],
+            n_cols=settings["plate_n_cols"],
+        )
+        if _reserve_well(year, week, key):
+            return key, ""
+    return None, "All samples have been taken this week."
 
 
 def add_new_sample(
@@ -556,12 +1644,12 @@ def add_new_sample(
                         f"Saving {reference_sequence_file.filename} to temporary file {temp_file}"
                     )
                     reference_sequence_file.save(temp_file)
-                ref_seq_basename = str(ref_seq_dir / f"{key}_{name}")
-                zip_filename = shutil.make_archive(
-                    base_name=ref_seq_basename,
-                    format="zip",
-                    root_dir=tmp_dir,
+                zip_filename = ref_seq_dir / f"{key}_{name}.zip"
+                tmp_path = _new_blob_tmp_path()
+                _write_reference_seq_zip(
+                    tmp_path, list(pathlib.Path(tmp_dir).iterdir())
                 )
+                _store_blob(tmp_path, zip_filename)
                 logger.info(f"  -> created zip file {zip_filename}")
             has_reference_seq_zip = True
         except Exception as e:
@@ -610,9 +1698,7 @@ def resubmit_sample(primary_key: str) -> Tuple[str, int]:
         pathlib.Path(new_sample.reference_seq_zip_path()).resolve().parent.mkdir(
             parents=True, exist_ok=True
         )
-        shutil.copy(
-            sample.reference_seq_zip_path(), new_sample.reference_seq_zip_path()
-        )
+        _link_file(sample.reference_seq_zip_path(), new_sample.reference_seq_zip_path())
     db.session.add(new_sample)
     db.session.commit()
     return (
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from typing import Callable, Dict
+import concurrent.futures
+import threading
+import argon2
+from sample_flow_server.logger import get_logger
+
+logger = get_logger("SampleFlowServer")
+
+
+class PasswordHasherBusyError(Exception):
+    pass
+
+
+class PasswordHasherPool:
+    # argon2 hashes are deliberately expensive to compute, so they are computed
+    # by at most max_workers threads (argon2 releases the GIL while hashing),
+    # with at most max_queued further requests waiting for a free thread.
+    # Requests beyond this, or that don't complete within timeout seconds,
+    # raise PasswordHasherBusyError instead of tying up the request thread.
+    def __init__(self, max_workers: int, max_queued: int, timeout: float):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._hasher = argon2.PasswordHasher()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="argon2"
+        )
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._lock = threading.Lock()
+        self._in_progress = 0
+        self._rejected = 0
+
+    def _release(self, _future: concurrent.futures.Future) -> None:
+        with self._lock:
+            self._in_progress -= 1
+        self._slots.release()
+
+    def _run(self, function: Callable, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            logger.warning("Password hasher queue full: rejecting request")
+            raise PasswordHasherBusyError("Too many password requests")
+        with self._lock:
+            self._in_progress += 1
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            # if it has not started yet it is removed from the queue
+            future.cancel()
+            with self._lock:
+                self._rejected += 1
+            logger.warning("Password hasher timed out")
+            raise PasswordHasherBusyError("Timed out waiting for password hasher")
+
+    def hash(self, password: str) -> str:
+        return self._run(self._hasher.hash, password)
+
+    def _verify(self, password_hash: str, password: str) -> bool:
+        try:
+            return self._hasher.verify(password_hash, password)
+        except argon2.exceptions.VerificationError:
+            return False
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(self._verify, password_hash, password)
+
+    def check_needs_rehash(self, password_hash: str) -> bool:
+        # only parses the parameters from the hash, so is cheap
+        return self._hasher.check_needs_rehash(password_hash)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queued": self.max_queued,
+                "in_progress": self._in_progress,
+                "rejected": self._rejected,
+            }
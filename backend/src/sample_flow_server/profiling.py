@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+import cProfile
+import datetime
+import fcntl
+import json
+import os
+import pathlib
+import re
+import time
+import flask
+from sample_flow_server.logger import get_logger
+from sample_flow_server.metrics import request_route
+
+logger = get_logger("SampleFlowServer")
+
+MAX_PROFILED_REQUESTS = 100
+# older profiles are deleted when there are more than this
+MAX_PROFILES = 100
+_PROFILE_NAME_REGEX = re.compile(
+    r"^[0-9]{8}T[0-9]{6}\.[0-9]{6}-[0-9]+-[a-z0-9_]+\.prof$"
+)
+
+
+def _profiles_dir() -> str:
+    return f"{flask.current_app.config['CIRCUITSEQ_DATA_PATH']}/profiles"
+
+
+def _control_path() -> str:
+    # if this file exists, profiling is armed: it is shared by all worker processes
+    return f"{_profiles_dir()}/control.json"
+
+
+class _ControlLock:
+    # exclusive lock for reading or modifying the control file
+    def __enter__(self):
+        pathlib.Path(_profiles_dir()).mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(f"{_profiles_dir()}/.lock", "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        self._lock_file.close()
+
+
+def _read_control() -> Optional[Dict]:
+    try:
+        with open(_control_path()) as f:
+            control = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if control["remaining"] <= 0 or control["expires"] <= time.time():
+        os.remove(_control_path())
+        return None
+    return control
+
+
+def _write_control(control: Dict) -> None:
+    tmp_path = f"{_control_path()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(control, f)
+    os.replace(tmp_path, _control_path())
+
+
+def arm_profiling(
+    n_requests: int, route: Optional[str], expires_in: float
+) -> Tuple[str, int]:
+    if not isinstance(n_requests, int) or not isinstance(expires_in, (int, float)):
+        return "Invalid profiling options", 400
+    if n_requests < 1 or n_requests > MAX_PROFILED_REQUESTS:
+        return f"Number of requests must be between 1 and {MAX_PROFILED_REQUESTS}", 400
+    if expires_in <= 0:
+        return "Expiry time must be positive", 400
+    if route is not None and route not in [
+        rule.rule for rule in flask.current_app.url_map.iter_rules()
+    ]:
+        return f"Unknown route {route}", 400
+    with _ControlLock():
+        _write_control(
+            {
+                "remaining": n_requests,
+                "route": route,
+                "expires": time.time() + expires_in,
+            }
+        )
+    logger.info(f"Profiling armed for {n_requests} requests to {route or 'any route'}")
+    return "Profiling armed", 200
+
+
+def disarm_profiling() -> Tuple[str, int]:
+    with _ControlLock():
+        if _read_control() is None:
+            return "Profiling is not armed", 200
+        os.remove(_control_path())
+    logger.info("Profiling disarmed")
+    return "Profiling disarmed", 200
+
+
+def profiling_status() -> Dict:
+    with _ControlLock():
+        control = _read_control()
+    return {
+        "armed": control is not None,
+        "control": control,
+        "profiles": list_profiles(),
+    }
+
+
+def list_profiles() -> List[Dict]:
+    profiles = []
+    for path in sorted(pathlib.Path(_profiles_dir()).glob("*.prof"), reverse=True):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        profiles.append(
+            {
+                "name": path.name,
+                "size": stat.st_size,
+                "created": datetime.datetime.fromtimestamp(stat.st_mtime),
+            }
+        )
+    return profiles
+
+
+def get_profile_path(name: str) -> Optional[pathlib.Path]:
+    if _PROFILE_NAME_REGEX.match(name) is None:
+        return None
+    path = pathlib.Path(_profiles_dir()) / name
+    if not path.is_file():
+        return None
+    return path
+
+
+def _claim_profiled_request(route: str) -> bool:
+    with _ControlLock():
+        control = _read_control()
+        if control is None:
+            return False
+        if control["route"] is not None and control["route"] != route:
+            return False
+        control["remaining"] -= 1
+        if control["remaining"] > 0:
+            _write_control(control)
+        else:
+            os.remove(_control_path())
+    return True
+
+
+def start_request() -> None:
+    # when profiling is not armed this only checks that the control file does not exist
+    if not os.path.exists(_control_path()):
+        return
+    route = request_route()
+    if not _claim_profiled_request(route):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # from python 3.12 only one profiler can be active at a time
+        logger.warning(f"Not profiling request to {route}: {e}")
+        return
+    flask.g.profiler = profiler
+
+
+def end_request() -> None:
+    profiler = flask.g.pop("profiler", None)
+    if profiler is None:
+        return
+    profiler.disable()
+    route = request_route()
+    slug = re.sub(r"[^a-z0-9]+", "_", route.lower()).strip("_") or "root"
+    timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S.%f")
+    path = f"{_profiles_dir()}/{timestamp}-{os.getpid()}-{slug}.prof"
+    profiler.dump_stats(path)
+    logger.info(f"Wrote profile of request to {route} to {path}")
+    for old_profile in list_profiles()[MAX_PROFILES:]:
+        try:
+            os.remove(f"{_profiles_dir()}/{old_profile['name']}")
+        except OSError:
+            pass
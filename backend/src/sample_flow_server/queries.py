@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Tuple
+import collections
+import contextlib
+import dataclasses
+import threading
+import time
+import flask
+import sqlalchemy
+from sample_flow_server import metrics
+from sample_flow_server.logger import get_logger
+
+logger = get_logger("SampleFlowServer")
+
+
+@dataclasses.dataclass
+class QueryRecord:
+    statement: str
+    # used to find identical statements, the parameters themselves are not kept
+    parameters_hash: int
+    duration: float
+    route: str
+
+
+_recorders = threading.local()
+
+
+@contextlib.contextmanager
+def record_queries() -> Iterator[List[QueryRecord]]:
+    # yields a list of the statements executed in this thread inside the block
+    records: List[QueryRecord] = []
+    stack = _recorders.__dict__.setdefault("stack", [])
+    stack.append(records)
+    try:
+        yield records
+    finally:
+        stack.remove(records)
+
+
+# longer str or bytes parameters, e.g. email messages, are hashed by their length
+# only, as hashing them on every statement would be expensive
+MAX_HASHED_PARAMETER_SIZE = 1024
+
+
+def _hashable_parameters(parameters):
+    if isinstance(parameters, (str, bytes, bytearray, memoryview)):
+        if len(parameters) > MAX_HASHED_PARAMETER_SIZE:
+            return type(parameters).__name__, len(parameters)
+        return parameters if isinstance(parameters, (str, bytes)) else bytes(parameters)
+    if isinstance(parameters, (list, tuple)):
+        return tuple(_hashable_parameters(value) for value in parameters)
+    if isinstance(parameters, dict):
+        return tuple(
+            (key, _hashable_parameters(value)) for key, value in parameters.items()
+        )
+    return parameters
+
+
+def _parameters_hash(parameters) -> int:
+    try:
+        return hash(_hashable_parameters(parameters))
+    except TypeError:
+        return 0
+
+
+def _current_route() -> str:
+    if not flask.has_request_context():
+        return ""
+    return metrics.request_route()
+
+
+def instrument_engine(engine, slow_query_threshold: float) -> None:
+    # records the duration of each SQL statement and the route it was executed for,
+    # and logs statements that take longer than slow_query_threshold seconds
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        # start time of the statement currently executing on each cursor
+        conn.info.setdefault("query_start_times", {})[id(cursor)] = time.perf_counter()
+
+    @sqlalchemy.event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        # after_cursor_execute is not called for a statement that fails, and a
+        # connection only executes one statement at a time
+        if exception_context.connection is not None:
+            exception_context.connection.info.pop("query_start_times", None)
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start_time = conn.info.get("query_start_times", {}).pop(id(cursor), None)
+        if start_time is None:
+            return
+        duration = time.perf_counter() - start_time
+        route = _current_route()
+        if duration >= slow_query_threshold:
+            logger.warning(
+                f"Slow SQL statement for {route or 'no request'} "
+                f"took {duration:.3f}s: {statement}"
+            )
+            metrics.inc("sample_flow_db_slow_queries_total", route=route)
+        record = QueryRecord(statement, _parameters_hash(parameters), duration, route)
+        if flask.has_request_context() and "sql_queries" in flask.g:
+            flask.g.sql_queries.append(record)
+        for records in getattr(_recorders, "stack", []):
+            records.append(record)
+
+
+def repeated_queries(records: List[QueryRecord]) -> Dict[str, int]:
+    # statements executed more than once with identical parameters, with their count
+    counts: Dict[Tuple[str, int], int] = collections.Counter(
+        (record.statement, record.parameters_hash) for record in records
+    )
+    repeated: Dict[str, int] = {}
+    for (statement, _), count in counts.items():
+        if count > 1:
+            repeated[statement] = max(repeated.get(statement, 0), count)
+    return repeated
+
+
+def start_request() -> None:
+    flask.g.sql_queries = []
+
+
+def end_request() -> List[QueryRecord]:
+    # returns the statements executed in this request, after logging any repeats
+    sql_queries = flask.g.pop("sql_queries", [])
+    if not sql_queries:
+        return sql_queries
+    route = metrics.request_route()
+    for statement, count in repeated_queries(sql_queries).items():
+        logger.warning(
+            f"Identical SQL statement executed {count} times for {route}: {statement}"
+        )
+        metrics.inc("sample_flow_db_repeated_queries_total", count - 1, route=route)
+    return sql_queries
@@ -46,6 +46,16 @@ def decode_password_reset_token(token: str, secret_key: str) -> Optional[str]:
     )
 
 
+def encode_download_token(path: str, secret_key: str) -> str:
+    return _encode_string_as_token(path, "download", secret_key)
+
+
+def decode_download_token(
+    token: str, secret_key: str, max_age_secs: int
+) -> Optional[str]:
+    return _decode_string_from_token(token, "download", secret_key, max_age_secs)
+
+
 def get_start_of_week(current_date: Optional[datetime.date] = None) -> datetime.date:
     if current_date is None:
         current_date = datetime.date.today()
@@ -1,8 +1,8 @@
 from __future__ import annotations
 import pytest
 from sample_flow_server import create_app
+from sample_flow_server.model import db
 import shutil
-import flask
 import io
 import os
 import sys
@@ -13,28 +13,35 @@ import smtplib
 sys.path.append(os.path.join(os.path.dirname(__file__), "helpers"))
 
 import flask_test_utils as ftu
+import smtp_test_utils as stu
+
+
+@pytest.fixture(autouse=True)
+def local_smtp(monkeypatch):
+    # send emails in the request that creates them using a local SMTP stand-in
+    monkeypatch.setenv("EMAIL_DELIVERY", "immediate")
+    stu.LocalSMTP.reset()
+    monkeypatch.setattr(smtplib, "SMTP", stu.LocalSMTP)
+    yield stu.LocalSMTP
 
 
 @pytest.fixture()
 def app(monkeypatch, tmp_path):
     monkeypatch.setenv("JWT_SECRET_KEY", "abcdefghijklmnopqrstuvwxyz")
-    monkeypatch.setattr(
-        smtplib.SMTP,
-        "__init__",
-        lambda self, host: print(f"Monkeypatched SMTP host: {host}", flush=True),
-    )
-    monkeypatch.setattr(
-        smtplib.SMTP,
-        "send_message",
-        lambda self, msg: flask.current_app.config.update(
-            TESTING_ONLY_LAST_SMTP_MESSAGE=msg
-        ),
-    )
+    # to run the tests using a database server instead of SQLite, set
+    # SAMPLE_FLOW_TEST_DATABASE_URI to the uri of a test database: any
+    # existing tables in this database are deleted before each test
+    test_database_uri = os.environ.get("SAMPLE_FLOW_TEST_DATABASE_URI")
+    if test_database_uri is not None:
+        monkeypatch.setenv("DATABASE_URI", test_database_uri)
+        ftu.drop_all_tables(test_database_uri)
     temp_data_path = str(tmp_path)
     app = create_app(data_path=temp_data_path)
     ftu.add_test_users(app)
     ftu.add_test_samples(app, tmp_path)
     yield app
+    with app.app_context():
+        db.engine.dispose()
 
 
 @pytest.fixture()
@@ -1,9 +1,12 @@
 import argon2
 from sample_flow_server.model import User, Sample, db
+from sample_flow_server.queries import record_queries, repeated_queries
+import contextlib
 import datetime
 import pathlib
 import shutil
 import tempfile
+import sqlalchemy
 
 
 def add_test_users(app):
@@ -56,3 +59,26 @@ def add_test_samples(app, data_path: pathlib.Path):
             )
             db.session.add(new_sample)
             db.session.commit()
+
+
+def drop_all_tables(database_uri: str):
+    engine = sqlalchemy.create_engine(database_uri)
+    metadata = sqlalchemy.MetaData()
+    metadata.reflect(engine)
+    metadata.drop_all(engine)
+    engine.dispose()
+
+
+@contextlib.contextmanager
+def assert_max_queries(max_queries: int, allow_repeated: bool = False):
+    # fails if more than max_queries SQL statements are executed in the block,
+    # or if an identical statement is executed more than once
+    with record_queries() as queries:
+        yield queries
+    statements = "\n".join(query.statement for query in queries)
+    assert (
+        len(queries) <= max_queries
+    ), f"{len(queries)} > {max_queries} SQL statements executed:\n{statements}"
+    if not allow_repeated:
+        repeated = repeated_queries(queries)
+        assert not repeated, f"Identical SQL statements executed: {repeated}"
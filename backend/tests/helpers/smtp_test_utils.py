@@ -0,0 +1,37 @@
+from __future__ import annotations
+from typing import List
+from email.message import EmailMessage
+import smtplib
+import flask
+
+
+class LocalSMTP:
+    # local stand-in for smtplib.SMTP: messages are stored instead of being sent.
+    # the last message sent is also stored in the app config as TESTING_ONLY_LAST_SMTP_MESSAGE
+    connections: int = 0
+    failures_remaining: int = 0
+    sent_messages: List[EmailMessage] = []
+
+    @classmethod
+    def reset(cls):
+        cls.connections = 0
+        cls.failures_remaining = 0
+        cls.sent_messages = []
+
+    def __init__(self, host: str = "", *args, **kwargs):
+        print(f"Local SMTP stand-in host: {host}", flush=True)
+        LocalSMTP.connections += 1
+
+    def send_message(self, msg: EmailMessage):
+        if LocalSMTP.failures_remaining > 0:
+            LocalSMTP.failures_remaining -= 1
+            raise smtplib.SMTPServerDisconnected("Local SMTP stand-in failure")
+        LocalSMTP.sent_messages.append(msg)
+        if flask.has_app_context():
+            flask.current_app.config.update(TESTING_ONLY_LAST_SMTP_MESSAGE=msg)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
@@ -1,9 +1,14 @@
 from __future__ import annotations
 from typing import Dict
 import io
+import os
+import base64
 import zipfile
 from freezegun import freeze_time
 import pathlib
+import pstats
+import pytest
+import sqlalchemy
 import sample_flow_server
 import flask_test_utils as ftu
 
@@ -52,6 +57,86 @@ def test_login_valid(client):
     assert response.json["user"]["is_admin"] is False
 
 
+def test_login_busy(client):
+    # all password hasher threads busy and queue full
+    password_hasher = client.application.extensions["password_hasher"]
+    n_slots = password_hasher.max_workers + password_hasher.max_queued
+    for _ in range(n_slots):
+        password_hasher._slots.acquire()
+    response = client.post(
+        "/api/login", json={"email": "user@embl.de", "password": "user"}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert "busy" in response.json["message"]
+    response = client.post(
+        "/api/signup", json={"email": "new@embl.de", "password": "Abcdefgh1"}
+    )
+    assert response.status_code == 503
+    # endpoints that don't use the password hasher are not affected
+    assert client.get("/api/remaining").status_code == 200
+    for _ in range(n_slots):
+        password_hasher._slots.release()
+    response = client.post(
+        "/api/login", json={"email": "user@embl.de", "password": "user"}
+    )
+    assert response.status_code == 200
+
+
+def _login(client, email: str, password: str, ip: str = "127.0.0.1"):
+    return client.post(
+        "/api/login",
+        json={"email": email, "password": password},
+        environ_base={"REMOTE_ADDR": ip},
+    )
+
+
+def test_login_throttle(client):
+    with freeze_time("2022-11-21 12:00:00") as frozen_time:
+        # successful logins are not counted
+        for _ in range(6):
+            assert _login(client, "user@embl.de", "user").status_code == 200
+        # 5 failed attempts for an email address within 5 mins
+        for _ in range(5):
+            assert _login(client, "user@embl.de", "wrong").status_code == 400
+            frozen_time.tick(10)
+        # further attempts rejected, even with the correct password
+        response = _login(client, "user@embl.de", "user")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "250"
+        # other email addresses not affected
+        assert _login(client, "admin@embl.de", "admin").status_code == 200
+        # first failed attempt expires -> one more attempt allowed
+        frozen_time.tick(250)
+        assert _login(client, "user@embl.de", "user").status_code == 200
+        frozen_time.tick(600)
+        # 20 failed attempts from an ip address, using different email addresses
+        for n in range(20):
+            response = _login(client, f"user{n}@embl.de", "wrong", "1.2.3.4")
+            assert response.status_code == 400
+        response = _login(client, "user@embl.de", "user", "1.2.3.4")
+        assert response.status_code == 429
+        # other ip addresses not affected
+        assert _login(client, "user@embl.de", "user", "1.2.3.5").status_code == 200
+        headers = {
+            "Authorization": f"Bearer {_login(client, 'admin@embl.de', 'admin').json['access_token']}"
+        }
+        response = client.get("/api/admin/login_throttle", headers=headers)
+        assert response.status_code == 200
+        status = response.json
+        assert status["window"] == 300
+        assert status["max_failures_per_email"] == 5
+        assert status["max_failures_per_ip"] == 20
+        assert status["failures_by_ip"] == {"1.2.3.4": 20}
+        assert status["throttled_ips"] == ["1.2.3.4"]
+        assert status["throttled_emails"] == []
+        assert len(status["failures_by_email"]) == 20
+        response = client.get(
+            "/api/admin/login_throttle", headers=_get_auth_headers(client)
+        )
+        assert response.status_code == 400
+
+
 def test_change_password_invalid(client):
     headers = _get_auth_headers(client)
     response = client.post(
@@ -100,6 +185,38 @@ def test_change_password_valid(client):
     assert response.status_code == 200
 
 
+def test_change_password_other_app_instance(tmp_path, monkeypatch):
+    monkeypatch.setenv("JWT_SECRET_KEY", "0123456789abcdefghijklmnopqrstuvwxyz")
+    app1 = sample_flow_server.create_app(data_path=str(tmp_path))
+    ftu.add_test_users(app1)
+    client1 = app1.test_client()
+    headers1 = _get_auth_headers(client1)
+    # another worker process using the same database has the user cached
+    app2 = sample_flow_server.create_app(data_path=str(tmp_path))
+    client2 = app2.test_client()
+    headers2 = _get_auth_headers(client2)
+    assert client2.get("/api/samples", headers=headers2).status_code == 200
+    response = client1.post(
+        "/api/change_password",
+        headers=headers1,
+        json={"current_password": "user", "new_password": "abc123"},
+    )
+    assert response.status_code == 200
+    # the old password is no longer accepted by the other worker
+    response = client2.post(
+        "/api/change_password",
+        headers=headers2,
+        json={"current_password": "user", "new_password": "def456"},
+    )
+    assert response.status_code == 400
+    response = client2.post(
+        "/api/change_password",
+        headers=headers2,
+        json={"current_password": "abc123", "new_password": "def456"},
+    )
+    assert response.status_code == 200
+
+
 def test_jwt_same_secret_persists_valid_tokens(tmp_path, monkeypatch):
     monkeypatch.setenv("JWT_SECRET_KEY", "0123456789abcdefghijklmnopqrstuvwxyz")
     app1 = sample_flow_server.create_app(data_path=str(tmp_path))
@@ -175,6 +292,52 @@ def test_reference_sequence_valid(client):
     assert "test.txt" in filenames
 
 
+@freeze_time("2022-11-21")
+def test_reference_sequence_get(client):
+    headers = _get_auth_headers(client)
+    response = client.get("/api/reference_sequence/22_46_A1", headers=headers)
+    assert response.status_code == 200
+    zip_file = zipfile.ZipFile(io.BytesIO(response.data))
+    assert zip_file.namelist() == ["test.txt"]
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "private" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+    assert not etag.startswith("W/")
+    # unchanged file is not sent again
+    response = client.get(
+        "/api/reference_sequence/22_46_A1",
+        headers={**headers, "If-None-Match": etag},
+    )
+    assert response.status_code == 304
+    assert response.data == b""
+    # partial download
+    full_data = zip_file.fp.getvalue()
+    response = client.get(
+        "/api/reference_sequence/22_46_A1",
+        headers={**headers, "Range": "bytes=10-"},
+    )
+    assert response.status_code == 206
+    assert response.data == full_data[10:]
+    # range is ignored if the file has changed
+    response = client.get(
+        "/api/reference_sequence/22_46_A1",
+        headers={**headers, "Range": "bytes=10-", "If-Range": '"changed"'},
+    )
+    assert response.status_code == 200
+    assert response.data == full_data
+    # other user's sample
+    admin_headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.post(
+        "/api/sample",
+        data={"name": "abc", "running_option": "r Q", "concentration": 97},
+        headers=admin_headers,
+    )
+    primary_key = response.json["sample"]["primary_key"]
+    response = client.get(f"/api/reference_sequence/{primary_key}", headers=headers)
+    assert response.status_code == 400
+    assert "not found" in response.json["message"]
+
+
 def test_running_options_invalid(client):
     # no auth header
     response = client.get("/api/running_options")
@@ -299,6 +462,37 @@ def test_result_valid(client, result_zipfile):
     assert len(response.data) > 1
 
 
+def test_result_get(client, result_zipfile):
+    headers = _get_auth_headers(client, "user@embl.de", "user")
+    key = "22_46_A2"
+    response = client.get(f"/api/result/{key}", headers=headers)
+    assert response.status_code == 400
+    assert _upload_result(client, result_zipfile, key).status_code == 200
+    response = client.get(f"/api/result/{key}", headers=headers)
+    assert response.status_code == 200
+    assert response.data == result_zipfile.read_bytes()
+    etag = response.headers["ETag"]
+    response = client.get(
+        f"/api/result/{key}", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    response = client.get(
+        f"/api/result/{key}", headers={**headers, "Range": "bytes=0-9"}
+    )
+    assert response.status_code == 206
+    assert response.data == result_zipfile.read_bytes()[:10]
+    # new result file -> new etag
+    os.utime(
+        pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+        / "2022/46/results/22_46_A2_ZIP_TEST_pMC_Final_Kan.zip",
+        (0, 0),
+    )
+    response = client.get(
+        f"/api/result/{key}", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+
+
 def test_admin_settings_invalid(client):
     # no auth header
     response = client.get("/api/admin/settings")
@@ -353,6 +547,41 @@ def test_admin_samples_valid(client):
     assert "previous_samples" in response.json
 
 
+def test_admin_samples_pages(client):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/samples?limit=3", headers=headers)
+    assert response.status_code == 200
+    assert response.json["current_samples"] == []
+    assert [s["primary_key"] for s in response.json["previous_samples"]] == [
+        "22_46_A4",
+        "22_46_A3",
+        "22_46_A2",
+    ]
+    cursor = response.json["next_cursor"]
+    assert cursor is not None
+    response = client.get(
+        f"/api/admin/samples?limit=3&cursor={cursor}", headers=headers
+    )
+    assert response.status_code == 200
+    assert [s["primary_key"] for s in response.json["previous_samples"]] == ["22_46_A1"]
+    assert response.json["next_cursor"] is None
+    # date range filters
+    response = client.get(
+        "/api/admin/samples?from=2022-11-15&to=2022-11-16", headers=headers
+    )
+    assert response.status_code == 200
+    assert [s["primary_key"] for s in response.json["previous_samples"]] == [
+        "22_46_A3",
+        "22_46_A2",
+    ]
+    assert response.json["next_cursor"] is None
+    # invalid parameters
+    for query in ["cursor=abc", "from=yesterday", "limit=many"]:
+        response = client.get(f"/api/admin/samples?{query}", headers=headers)
+        assert response.status_code == 400
+        assert "Invalid" in response.json["message"]
+
+
 def test_admin_token_invalid(client):
     # no auth header
     response = client.get("/api/admin/token")
@@ -376,6 +605,255 @@ def test_admin_token_valid(client):
     )
 
 
+def test_admin_email_status(client):
+    response = client.get("/api/admin/email_status")
+    assert response.status_code == 401
+    headers = _get_auth_headers(client)
+    response = client.get("/api/admin/email_status", headers=headers)
+    assert response.status_code == 400
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/email_status", headers=headers)
+    assert response.status_code == 200
+    assert response.json["circuit_breaker"]["state"] == "closed"
+    assert response.json["circuit_breaker"]["degraded"] is False
+    assert response.json["pending_emails"] == 0
+    assert response.json["failed_emails"] == 0
+
+
+def test_admin_remove_unused_blobs(client):
+    response = client.post("/api/admin/remove_unused_blobs")
+    assert response.status_code == 401
+    headers = _get_auth_headers(client)
+    response = client.post("/api/admin/remove_unused_blobs", headers=headers)
+    assert response.status_code == 400
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.post("/api/admin/remove_unused_blobs", headers=headers)
+    assert response.status_code == 200
+    assert response.json == {"blobs": 0, "tmp_files": 0, "bytes": 0}
+
+
+def test_admin_metrics(client):
+    response = client.get("/api/admin/metrics")
+    assert response.status_code == 401
+    headers = _get_auth_headers(client)
+    response = client.get("/api/admin/metrics", headers=headers)
+    assert response.status_code == 400
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/metrics", headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    # previous requests are included
+    assert (
+        'sample_flow_http_requests_total{method="GET",route="/api/admin/metrics",status="400"} 1'
+        in text
+    )
+    assert (
+        'sample_flow_http_requests_total{method="POST",route="/api/login",status="200"} 2'
+        in text
+    )
+    assert (
+        'sample_flow_http_request_duration_seconds_count{method="POST",route="/api/login"} 2'
+        in text
+    )
+    assert 'sample_flow_db_queries_per_request_count{route="/api/login"} 2' in text
+    assert "sample_flow_password_verify_duration_seconds_count 2" in text
+    client.get("/api/no_such_route")
+    response = client.get("/api/admin/metrics", headers=headers)
+    text = response.get_data(as_text=True)
+    assert (
+        'sample_flow_http_requests_total{method="GET",route="/api/admin/metrics",status="200"} 1'
+        in text
+    )
+    assert (
+        'sample_flow_http_requests_total{method="GET",route="unmatched",status="404"} 1'
+        in text
+    )
+
+
+def test_admin_profiling(client, tmp_path):
+    response = client.get("/api/admin/profiling")
+    assert response.status_code == 401
+    headers = _get_auth_headers(client)
+    response = client.get("/api/admin/profiling", headers=headers)
+    assert response.status_code == 400
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/profiling", headers=headers)
+    assert response.status_code == 200
+    assert response.json["armed"] is False
+    assert response.json["profiles"] == []
+    # invalid options
+    for options in [
+        {"requests": 0},
+        {"requests": 1000},
+        {"requests": "2"},
+        {"requests": 2, "expires_in": -1},
+        {"requests": 2, "route": "/api/no_such_route"},
+    ]:
+        response = client.post("/api/admin/profiling", headers=headers, json=options)
+        assert response.status_code == 400
+    # profile the next 2 requests to /api/admin/samples
+    response = client.post(
+        "/api/admin/profiling",
+        headers=headers,
+        json={"requests": 2, "route": "/api/admin/samples"},
+    )
+    assert response.status_code == 200
+    response = client.get("/api/admin/profiling", headers=headers)
+    assert response.json["armed"] is True
+    assert response.json["control"]["remaining"] == 2
+    assert response.json["control"]["route"] == "/api/admin/samples"
+    for _ in range(3):
+        response = client.get("/api/admin/samples", headers=headers)
+        assert response.status_code == 200
+    response = client.get("/api/admin/profiling", headers=headers)
+    assert response.json["armed"] is False
+    profiles = response.json["profiles"]
+    assert len(profiles) == 2
+    assert all(p["name"].endswith("-api_admin_samples.prof") for p in profiles)
+    # download a profile
+    response = client.get(
+        f"/api/admin/profiling/{profiles[0]['name']}", headers=headers
+    )
+    assert response.status_code == 200
+    with open(tmp_path / "downloaded.prof", "wb") as f:
+        f.write(response.data)
+    stats = pstats.Stats(str(tmp_path / "downloaded.prof"))
+    assert any("admin_all_samples" in key[2] for key in stats.stats)
+    for name in ["no_such_profile.prof", "..%2Fcontrol.json", profiles[0]["name"][1:]]:
+        response = client.get(f"/api/admin/profiling/{name}", headers=headers)
+        assert response.status_code == 404
+    # profile the next request to any route, then disarm
+    response = client.post("/api/admin/profiling", headers=headers, json={})
+    assert response.status_code == 200
+    client.get("/api/remaining")
+    response = client.get("/api/admin/profiling", headers=headers)
+    assert response.json["armed"] is False
+    assert len(response.json["profiles"]) == 3
+    assert response.json["profiles"][0]["name"].endswith("-api_remaining.prof")
+    response = client.post(
+        "/api/admin/profiling",
+        headers=headers,
+        json={"requests": 5, "route": "/api/admin/zipsamples"},
+    )
+    assert response.status_code == 200
+    response = client.delete("/api/admin/profiling", headers=headers)
+    assert response.status_code == 200
+    assert response.json["message"] == "Profiling disarmed"
+    response = client.get("/api/admin/profiling", headers=headers)
+    assert response.json["armed"] is False
+    assert len(response.json["profiles"]) == 3
+
+
+@freeze_time("2022-11-21")
+def test_query_budgets(client):
+    user_headers = _get_auth_headers(client)
+    admin_headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    with ftu.assert_max_queries(8):
+        response = client.post(
+            "/api/login", json={"email": "user@embl.de", "password": "user"}
+        )
+        assert response.status_code == 200
+    with ftu.assert_max_queries(4):
+        response = client.get("/api/remaining")
+        assert response.status_code == 200
+    with ftu.assert_max_queries(3):
+        response = client.get("/api/samples", headers=user_headers)
+        assert response.status_code == 200
+    with ftu.assert_max_queries(3):
+        response = client.get("/api/admin/samples", headers=admin_headers)
+        assert response.status_code == 200
+    with ftu.assert_max_queries(1):
+        response = client.get("/api/admin/users", headers=admin_headers)
+        assert response.status_code == 200
+    # the limit is enforced
+    with pytest.raises(AssertionError, match="2 > 1 SQL statements"):
+        with ftu.assert_max_queries(1):
+            client.get("/api/samples", headers=user_headers)
+
+
+def test_repeated_queries(app):
+    with app.app_context():
+        query = sqlalchemy.select(sample_flow_server.model.Sample).filter_by(id=1)
+        with pytest.raises(AssertionError, match="Identical SQL statements"):
+            with ftu.assert_max_queries(5):
+                sample_flow_server.model.db.session.execute(query).all()
+                sample_flow_server.model.db.session.execute(query).all()
+        # same statement with different parameters is allowed
+        with ftu.assert_max_queries(5):
+            for sample_id in [1, 2]:
+                sample_flow_server.model.db.session.execute(
+                    sqlalchemy.select(sample_flow_server.model.Sample).filter_by(
+                        id=sample_id
+                    )
+                ).all()
+
+
+def test_query_parameters_hash():
+    parameters_hash = sample_flow_server.queries._parameters_hash
+    small = {"id": 1, "message": b"abc"}
+    assert parameters_hash(small) == parameters_hash({"id": 1, "message": b"abc"})
+    assert parameters_hash(small) != parameters_hash({"id": 1, "message": b"abd"})
+    assert parameters_hash([(1, "a"), (2, "b")]) != parameters_hash([(1, "a")])
+    # large values are only hashed by their length
+    large = b"x" * (10 * 1024 * 1024)
+    assert parameters_hash((large,)) == parameters_hash((b"y" * len(large),))
+    assert parameters_hash((large,)) != parameters_hash((large + b"x",))
+    # unhashable parameters are all treated as identical
+    assert parameters_hash(({1},)) == 0
+
+
+def test_slow_query_log(monkeypatch, tmp_path, caplog):
+    monkeypatch.setenv("SQL_SLOW_QUERY_THRESHOLD", "0")
+    app = sample_flow_server.create_app(data_path=str(tmp_path))
+    ftu.add_test_users(app)
+    client = app.test_client()
+    caplog.clear()
+    client.post("/api/login", json={"email": "user@embl.de", "password": "user"})
+    assert "Slow SQL statement for /api/login took" in caplog.text
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/metrics", headers=headers)
+    assert 'sample_flow_db_slow_queries_total{route="/api/login"}' in response.text
+    with app.app_context():
+        sample_flow_server.model.db.engine.dispose()
+
+
+def test_request_metrics_unhandled_exception(app):
+    # exception is turned into a 500 response as in production
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+
+    @app.route("/api/test_error")
+    def test_error():
+        sample_flow_server.model.db.session.execute(sqlalchemy.text("SELECT 1"))
+        raise RuntimeError("test error")
+
+    client = app.test_client()
+    response = client.get("/api/test_error")
+    assert response.status_code == 500
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    text = client.get("/api/admin/metrics", headers=headers).text
+    # the request is recorded once
+    assert (
+        'sample_flow_http_requests_total{method="GET",route="/api/test_error",status="500"} 1\n'
+        in text
+    )
+    assert 'sample_flow_db_queries_total{route="/api/test_error"} 1\n' in text
+
+
+def test_failed_query_start_time(app):
+    with app.app_context():
+        connection = sample_flow_server.model.db.session.connection()
+        with pytest.raises(
+            sqlalchemy.exc.OperationalError
+            if connection.dialect.name == "sqlite"
+            else sqlalchemy.exc.ProgrammingError
+        ):
+            connection.execute(sqlalchemy.text("SELECT * FROM no_such_table"))
+        # the start time of the failed statement is not left on the connection
+        assert not connection.info.get("query_start_times")
+        sample_flow_server.model.db.session.rollback()
+
+
 def test_admin_users_invalid(client):
     # no auth header
     response = client.get("/api/admin/users")
@@ -438,12 +916,152 @@ def test_admin_zipsamples_valid(client, ref_seq_fasta):
     )
 
 
+@freeze_time("2022-11-21")
+def test_admin_zipsamples_stream(client, ref_seq_fasta):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.post(
+        "/api/sample",
+        data={
+            "name": "abc",
+            "running_option": "r Q",
+            "concentration": 97,
+            "file": (ref_seq_fasta, "test.fa"),
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    response = client.post("/api/admin/zipsamples?stream=true", headers=headers)
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == "application/zip"
+    zip_file = zipfile.ZipFile(io.BytesIO(response.data))
+    filenames = [f.filename for f in zip_file.filelist]
+    assert sorted(filenames) == [
+        "references/",
+        "references/22_47_A1_abc.zip",
+        "samples.tsv",
+    ]
+    assert zip_file.testzip() is None
+    tsv_lines = zip_file.read("samples.tsv").splitlines()
+    assert len(tsv_lines) == 2
+    assert (
+        tsv_lines[1] == b"2022-11-21\t22_47_A1\t22_47_A1\tadmin@embl.de\tabc\tr Q\t97"
+    )
+    reference_zip = zipfile.ZipFile(
+        io.BytesIO(zip_file.read("references/22_47_A1_abc.zip"))
+    )
+    assert reference_zip.namelist() == ["test.fa"]
+    # no intermediate zip file is created
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    assert not (data_path / "2022/47/samples.zip").exists()
+
+
 def test_admin_result_valid(client, result_zipfile):
     response = _upload_result(client, result_zipfile, "22_46_A2")
     assert response.status_code == 200
     assert "file saved" in response.json["message"]
 
 
+def test_admin_results_invalid(client):
+    response = client.post("/api/admin/results")
+    assert response.status_code == 401
+    headers = _get_auth_headers(client)
+    response = client.post("/api/admin/results", headers=headers)
+    assert response.status_code == 400
+
+
+def test_admin_results_archive(client, result_zipfile, local_smtp):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as archive_zip_file:
+        for name in [
+            "22_46_A1_ref_seq.zip",
+            "results/22_46_A2_ZIP_TEST_pMC_Final_Kan.zip",
+            "22_46_A9_unknown.zip",
+            "readme.txt",
+        ]:
+            archive_zip_file.write(result_zipfile, name)
+    archive.seek(0)
+    with open(result_zipfile, "rb") as f:
+        result_zipfile_bytes = f.read()
+    response = client.post(
+        "/api/admin/results",
+        data={
+            "archive": (archive, "results.zip"),
+            "file": (io.BytesIO(result_zipfile_bytes), "22_46_A3_ZIP_TEST_pCW571.zip"),
+            "failed": ["22_46_A4"],
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    report = response.json["results"]
+    assert len(report) == 6
+    for primary_key in ["22_46_A1", "22_46_A2", "22_46_A3"]:
+        assert report[primary_key]["code"] == 200
+        assert "file saved" in report[primary_key]["message"]
+    assert report["22_46_A4"]["code"] == 200
+    assert report["22_46_A9"]["code"] == 400
+    assert "Unknown primary key" in report["22_46_A9"]["message"]
+    assert report["readme.txt"]["code"] == 400
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    results_dir = data_path / "2022/46/results"
+    assert sorted(f.name for f in results_dir.iterdir()) == [
+        "22_46_A1_ref_seq.zip",
+        "22_46_A2_ZIP_TEST_pMC_Final_Kan.zip",
+        "22_46_A3_ZIP_TEST_pCW571.zip",
+    ]
+    for result_file in results_dir.iterdir():
+        assert result_file.read_bytes() == result_zipfile_bytes
+    assert len(local_smtp.sent_messages) == 4
+    # results are available to the user
+    user_headers = _get_auth_headers(client)
+    for primary_key in ["22_46_A1", "22_46_A2", "22_46_A3"]:
+        response = client.post(
+            "/api/result", json={"primary_key": primary_key}, headers=user_headers
+        )
+        assert response.status_code == 200
+    response = client.post(
+        "/api/result", json={"primary_key": "22_46_A4"}, headers=user_headers
+    )
+    assert response.status_code == 400
+
+
+@freeze_time("2022-11-21")
+def test_admin_results_resubmitted(client, result_zipfile):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.post(
+        "/api/admin/resubmit_sample",
+        json={"primary_key": "22_46_A2"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    with open(result_zipfile, "rb") as f:
+        result_zipfile_bytes = f.read()
+    # result for new primary key -> original primary key
+    response = client.post(
+        "/api/admin/results",
+        data={
+            "file": [
+                (
+                    io.BytesIO(result_zipfile_bytes),
+                    "22_47_A1_ZIP_TEST_pMC_Final_Kan.zip",
+                ),
+                (
+                    io.BytesIO(result_zipfile_bytes),
+                    "22_46_A2_ZIP_TEST_pMC_Final_Kan.zip",
+                ),
+            ]
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    report = response.json["results"]
+    assert report["22_47_A1"]["code"] == 200
+    assert "22_46_A2" in report["22_47_A1"]["message"]
+    assert report["22_46_A2"]["code"] == 400
+    assert "Multiple results" in report["22_46_A2"]["message"]
+
+
 @freeze_time("2022-11-21")
 def test_admin_resubmit_sample_valid(client, result_zipfile):
     headers = _get_auth_headers(client, "admin@embl.de", "admin")
@@ -475,3 +1093,289 @@ def test_admin_resubmit_sample_valid(client, result_zipfile):
     response = _upload_result(client, result_zipfile, "22_47_A1")
     assert response.status_code == 200
     assert primary_key in response.json["message"]
+
+
+def _create_upload(client, headers: Dict, filename: str, length: int):
+    encoded_filename = base64.b64encode(filename.encode()).decode()
+    return client.post(
+        "/api/upload",
+        headers={
+            **headers,
+            "Upload-Length": str(length),
+            "Upload-Metadata": f"filename {encoded_filename}",
+        },
+    )
+
+
+def _append_to_upload(client, headers: Dict, upload_id: str, offset: int, data):
+    return client.patch(
+        f"/api/upload/{upload_id}",
+        data=data,
+        headers={
+            **headers,
+            "Upload-Offset": str(offset),
+            "Content-Type": "application/offset+octet-stream",
+        },
+    )
+
+
+def test_upload_invalid(client):
+    headers = _get_auth_headers(client)
+    # no auth header
+    assert client.post("/api/upload").status_code == 401
+    # missing / invalid Upload-Length
+    assert client.post("/api/upload", headers=headers).status_code == 400
+    assert _create_upload(client, headers, "a.fa", -1).status_code == 400
+    response = _create_upload(client, headers, "a.fa", 5 * 1024 * 1024 * 1024)
+    assert response.status_code == 400
+    # invalid filename
+    assert _create_upload(client, headers, "..", 10).status_code == 400
+    response = _create_upload(client, headers, "a.fa", 4)
+    assert response.status_code == 201
+    upload_id = response.json["upload_id"]
+    # chunk longer than upload
+    response = _append_to_upload(client, headers, upload_id, 0, b"12345")
+    assert response.status_code == 413
+    # wrong content type
+    response = client.patch(
+        f"/api/upload/{upload_id}",
+        data=b"12",
+        headers={**headers, "Upload-Offset": "0"},
+    )
+    assert response.status_code == 415
+    # upload belongs to a different user
+    admin_headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = _append_to_upload(client, admin_headers, upload_id, 0, b"12")
+    assert response.status_code == 404
+    assert (
+        client.head(f"/api/upload/{upload_id}", headers=admin_headers).status_code
+        == 404
+    )
+    # incomplete upload can't be used
+    response = client.post(
+        "/api/sample",
+        data={
+            "name": "abc",
+            "running_option": "r Q",
+            "concentration": 97,
+            "upload_id": upload_id,
+        },
+        headers=headers,
+    )
+    assert response.status_code == 400
+    assert "Upload not found or incomplete" in response.json["message"]
+
+
+@freeze_time("2022-11-21")
+def test_upload_sample_reference_sequence(client, ref_seq_fasta):
+    headers = _get_auth_headers(client)
+    data = ref_seq_fasta.read()
+    response = _create_upload(client, headers, "test.fa", len(data))
+    assert response.status_code == 201
+    upload_id = response.json["upload_id"]
+    assert response.headers["Location"] == f"/api/upload/{upload_id}"
+    assert response.headers["Upload-Offset"] == "0"
+    # a cross-origin frontend can read the upload headers
+    response = client.head(
+        f"/api/upload/{upload_id}",
+        headers={**headers, "Origin": "http://localhost:5173"},
+    )
+    expose_headers = response.headers["Access-Control-Expose-Headers"].split(", ")
+    for header in ["Location", "Upload-Offset", "Upload-Length", "Tus-Resumable"]:
+        assert header in expose_headers
+    # upload first chunk
+    response = _append_to_upload(client, headers, upload_id, 0, data[:100])
+    assert response.status_code == 204
+    assert response.headers["Upload-Offset"] == "100"
+    # resend chunk from wrong offset
+    response = _append_to_upload(client, headers, upload_id, 0, data[:100])
+    assert response.status_code == 409
+    assert response.headers["Upload-Offset"] == "100"
+    # client gets current offset and resumes upload
+    response = client.head(f"/api/upload/{upload_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["Upload-Offset"] == "100"
+    assert response.headers["Upload-Length"] == str(len(data))
+    response = _append_to_upload(client, headers, upload_id, 100, data[100:])
+    assert response.status_code == 204
+    assert response.headers["Upload-Offset"] == str(len(data))
+    response = client.post(
+        "/api/sample",
+        data={
+            "name": "abc",
+            "running_option": "r Q",
+            "concentration": 97,
+            "upload_id": upload_id,
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert response.json["sample"]["has_reference_seq_zip"] is True
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    zip_path = data_path / "2022/47/inputs/references/22_47_A1_abc.zip"
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert zip_file.namelist() == ["test.fa"]
+        assert zip_file.read("test.fa") == data
+    # upload is removed once it has been used
+    assert client.head(f"/api/upload/{upload_id}", headers=headers).status_code == 404
+    assert list((data_path / "uploads").iterdir()) == []
+
+
+def test_upload_admin_result(client, result_zipfile):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    data = result_zipfile.read_bytes()
+    response = _create_upload(client, headers, result_zipfile.name, len(data))
+    assert response.status_code == 201
+    upload_id = response.json["upload_id"]
+    for offset in range(0, len(data), 64):
+        response = _append_to_upload(
+            client, headers, upload_id, offset, data[offset : offset + 64]
+        )
+        assert response.status_code == 204
+    response = client.post(
+        "/api/admin/result",
+        data={"primary_key": "22_46_A2", "success": True, "upload_id": upload_id},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert "file saved" in response.json["message"]
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    results_file = data_path / "2022/46/results/22_46_A2_ZIP_TEST_pMC_Final_Kan.zip"
+    assert results_file.read_bytes() == data
+    assert client.head(f"/api/upload/{upload_id}", headers=headers).status_code == 404
+
+
+def test_download_url(client, result_zipfile):
+    headers = _get_auth_headers(client)
+    # no auth header
+    response = client.get("/api/reference_sequence/22_46_A1/download_url")
+    assert response.status_code == 401
+    # other user's sample
+    response = client.get(
+        "/api/result/22_46_A2/download_url",
+        headers=_get_auth_headers(client, "admin@embl.de", "admin"),
+    )
+    assert response.status_code == 400
+    with freeze_time("2022-11-21 12:00:00"):
+        response = client.get(
+            "/api/reference_sequence/22_46_A1/download_url",
+            headers=_get_auth_headers(client),
+        )
+        assert response.status_code == 200
+        assert response.json["expires_in"] == 300
+        url = response.json["url"]
+        assert url.startswith("/api/download/")
+    # signed url can be used without auth header until it expires
+    with freeze_time("2022-11-21 12:04:00"):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert zipfile.ZipFile(io.BytesIO(response.data)).namelist() == ["test.txt"]
+        assert "22_46_A1_ref_seq.zip" in response.headers["Content-Disposition"]
+        assert client.get(f"{url}x").status_code == 400
+    with freeze_time("2022-11-21 12:06:00"):
+        response = client.get(url)
+        assert response.status_code == 400
+        assert "expired" in response.json["message"]
+    assert _upload_result(client, result_zipfile, "22_46_A2").status_code == 200
+    response = client.get("/api/result/22_46_A2/download_url", headers=headers)
+    assert response.status_code == 200
+    response = client.get(response.json["url"])
+    assert response.status_code == 200
+    assert response.data == result_zipfile.read_bytes()
+
+
+def test_accel_redirect(client, result_zipfile):
+    client.application.config["ACCEL_REDIRECT_LOCATION"] = "/sample_flow_data/"
+    headers = _get_auth_headers(client)
+    response = client.get("/api/reference_sequence/22_46_A1", headers=headers)
+    assert response.status_code == 200
+    assert response.data == b""
+    assert (
+        response.headers["X-Accel-Redirect"]
+        == "/sample_flow_data/2022/46/inputs/references/22_46_A1_ref_seq.zip"
+    )
+    assert response.headers["Content-Type"] == "application/zip"
+    assert (
+        response.headers["Content-Disposition"]
+        == "attachment; filename=22_46_A1_ref_seq.zip"
+    )
+    assert _upload_result(client, result_zipfile, "22_46_A2").status_code == 200
+    response = client.get("/api/result/22_46_A2/download_url", headers=headers)
+    response = client.get(response.json["url"])
+    assert response.status_code == 200
+    assert response.data == b""
+    assert (
+        response.headers["X-Accel-Redirect"]
+        == "/sample_flow_data/2022/46/results/22_46_A2_ZIP_TEST_pMC_Final_Kan.zip"
+    )
+
+
+def _sqlite_pragma(app, pragma: str):
+    with app.app_context():
+        return sample_flow_server.model.db.session.execute(
+            sqlalchemy.text(f"PRAGMA {pragma}")
+        ).scalar_one()
+
+
+@pytest.mark.skipif("SAMPLE_FLOW_TEST_DATABASE_URI" in os.environ, reason="SQLite only")
+def test_sqlite_pragmas(app, monkeypatch, tmp_path):
+    assert _sqlite_pragma(app, "journal_mode") == "wal"
+    assert _sqlite_pragma(app, "synchronous") == 1
+    assert _sqlite_pragma(app, "busy_timeout") == 10000
+    assert _sqlite_pragma(app, "mmap_size") == 256 * 1024 * 1024
+    assert _sqlite_pragma(app, "cache_size") == -64 * 1024
+    # pragmas can be set using env vars
+    monkeypatch.setenv("SQLITE_JOURNAL_MODE", "delete")
+    monkeypatch.setenv("SQLITE_SYNCHRONOUS", "FULL")
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT", "123")
+    monkeypatch.setenv("SQLITE_MMAP_SIZE", "0")
+    monkeypatch.setenv("SQLITE_CACHE_SIZE", "-1000")
+    data_path = tmp_path / "env"
+    data_path.mkdir()
+    env_app = sample_flow_server.create_app(data_path=str(data_path))
+    assert _sqlite_pragma(env_app, "journal_mode") == "delete"
+    assert _sqlite_pragma(env_app, "synchronous") == 2
+    assert _sqlite_pragma(env_app, "busy_timeout") == 123
+    assert _sqlite_pragma(env_app, "mmap_size") == 0
+    assert _sqlite_pragma(env_app, "cache_size") == -1000
+    monkeypatch.setenv("SQLITE_JOURNAL_MODE", "WAL; DROP TABLE user")
+    with pytest.raises(ValueError):
+        sample_flow_server.create_app(data_path=str(data_path))
+
+
+@pytest.mark.skipif("SAMPLE_FLOW_TEST_DATABASE_URI" in os.environ, reason="SQLite only")
+def test_sqlite_concurrent_read_write(app):
+    with app.app_context():
+        engine = sample_flow_server.model.db.engine
+        with engine.connect() as reader, engine.connect() as writer:
+            # open read transaction doesn't block a write from another connection
+            reader.exec_driver_sql("BEGIN")
+            n_users = reader.exec_driver_sql("SELECT COUNT(*) FROM user").scalar_one()
+            writer.exec_driver_sql(
+                "UPDATE user SET activated = 0 WHERE email = 'user@embl.de'"
+            )
+            writer.commit()
+            # reader still sees a consistent snapshot
+            assert (
+                reader.exec_driver_sql("SELECT COUNT(*) FROM user").scalar_one()
+                == n_users
+            )
+            reader.rollback()
+
+
+@pytest.mark.skipif(
+    "SAMPLE_FLOW_TEST_DATABASE_URI" not in os.environ,
+    reason="requires a database server",
+)
+def test_database_pool(app, monkeypatch, tmp_path):
+    with app.app_context():
+        assert sample_flow_server.model.db.engine.pool.size() == 5
+    monkeypatch.setenv("DATABASE_POOL_SIZE", "2")
+    monkeypatch.setenv("DATABASE_MAX_OVERFLOW", "3")
+    pool_app = sample_flow_server.create_app(data_path=str(tmp_path))
+    with pool_app.app_context():
+        engine = sample_flow_server.model.db.engine
+        assert engine.dialect.name != "sqlite"
+        assert engine.pool.size() == 2
+        assert engine.pool._max_overflow == 3
+        engine.dispose()
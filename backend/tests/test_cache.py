@@ -0,0 +1,34 @@
+from __future__ import annotations
+from freezegun import freeze_time
+from sample_flow_server.cache import TTLCache
+
+
+def test_ttl_cache():
+    with freeze_time("2022-11-21 09:00:00") as frozen_time:
+        cache = TTLCache(maxsize=2, ttl=60)
+        assert cache.get(1) is None
+        cache.set(1, "a")
+        cache.set(2, "b")
+        assert cache.get(1) == "a"
+        # least recently used item is removed
+        cache.set(3, "c")
+        assert len(cache) == 2
+        assert cache.get(2) is None
+        assert cache.get(1) == "a"
+        assert cache.get(3) == "c"
+        cache.invalidate(3)
+        assert cache.get(3) is None
+        # items expire after ttl
+        frozen_time.tick(59)
+        assert cache.get(1) == "a"
+        frozen_time.tick(1)
+        assert cache.get(1) is None
+        cache.set(1, "a")
+        cache.clear()
+        assert len(cache) == 0
+
+
+def test_ttl_cache_disabled():
+    cache = TTLCache(maxsize=0, ttl=60)
+    cache.set(1, "a")
+    assert cache.get(1) is None
@@ -0,0 +1,69 @@
+from __future__ import annotations
+from email.message import EmailMessage
+import pytest
+import smtplib
+from freezegun import freeze_time
+from sample_flow_server.mail import CircuitBreaker, CircuitOpenError, EmailSender
+
+
+def _email_message(email: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["To"] = email
+    msg.set_content("test")
+    return msg
+
+
+def test_circuit_breaker():
+    with freeze_time("2022-11-21 09:00:00") as frozen_time:
+        circuit_breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+        assert circuit_breaker.status()["state"] == "closed"
+        assert circuit_breaker.status()["degraded"] is False
+        assert circuit_breaker.allow()
+        circuit_breaker.record_failure()
+        assert circuit_breaker.allow()
+        circuit_breaker.record_failure()
+        # circuit opened after 2 consecutive failures
+        assert circuit_breaker.status()["state"] == "open"
+        assert circuit_breaker.status()["degraded"] is True
+        assert circuit_breaker.status()["consecutive_failures"] == 2
+        assert not circuit_breaker.allow()
+        frozen_time.tick(61)
+        # single trial call allowed after reset timeout
+        assert circuit_breaker.status()["state"] == "half-open"
+        assert circuit_breaker.allow()
+        assert not circuit_breaker.allow()
+        # trial call fails: circuit re-opens
+        circuit_breaker.record_failure()
+        assert circuit_breaker.status()["state"] == "open"
+        assert not circuit_breaker.allow()
+        frozen_time.tick(61)
+        # trial call succeeds: circuit closes
+        assert circuit_breaker.allow()
+        circuit_breaker.record_success()
+        assert circuit_breaker.status()["state"] == "closed"
+        assert circuit_breaker.status()["consecutive_failures"] == 0
+        assert circuit_breaker.allow()
+        assert circuit_breaker.allow()
+
+
+def test_email_sender(local_smtp):
+    circuit_breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+    with EmailSender("email:587", 1.0, circuit_breaker) as sender:
+        local_smtp.failures_remaining = 2
+        for _ in range(2):
+            with pytest.raises(smtplib.SMTPServerDisconnected):
+                sender.send(_email_message("a@embl.de"))
+        # circuit is open: sending fails without connecting to the server
+        n_connections = local_smtp.connections
+        with pytest.raises(CircuitOpenError):
+            sender.send(_email_message("a@embl.de"))
+        assert local_smtp.connections == n_connections
+        assert len(local_smtp.sent_messages) == 0
+
+
+def test_email_sender_reuses_connection(local_smtp):
+    with EmailSender("email:587", 1.0) as sender:
+        for email in ["a@embl.de", "b@embl.de"]:
+            sender.send(_email_message(email))
+    assert local_smtp.connections == 1
+    assert len(local_smtp.sent_messages) == 2
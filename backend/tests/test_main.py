@@ -0,0 +1,129 @@
+from __future__ import annotations
+from types import SimpleNamespace
+import importlib.util
+import click
+import pytest
+from click.testing import CliRunner
+import subprocess
+import sys
+import sample_flow_server.model
+from sample_flow_server import main
+from sample_flow_server.model import db
+
+
+def test_default_workers():
+    assert main.default_workers(1, None) == 3
+    assert main.default_workers(4, None) == 9
+    assert main.default_workers(4, 64 * 1024 * 1024 * 1024) == 9
+    # limited by memory
+    assert main.default_workers(4, 1024 * 1024 * 1024) == 4
+    # always at least one worker
+    assert main.default_workers(4, 16 * 1024 * 1024) == 1
+
+
+def test_gunicorn_options():
+    options = main.gunicorn_options(
+        "0.0.0.0", 8080, 3, "gthread", 8, True, 1000, 100, 120, 30, "/tmp/pid"
+    )
+    assert options["bind"] == "0.0.0.0:8080"
+    assert options["workers"] == 3
+    assert options["worker_class"] == "gthread"
+    assert options["threads"] == 8
+    assert options["preload_app"] is True
+    assert options["max_requests"] == 1000
+    assert options["max_requests_jitter"] == 100
+    assert options["graceful_timeout"] == 30
+    assert options["pidfile"] == "/tmp/pid"
+    # threads are only used by gthread workers
+    options = main.gunicorn_options(
+        "0.0.0.0", 8080, 3, "sync", 8, False, 0, 0, 120, 30, None
+    )
+    assert options["threads"] == 1
+    # gunicorn config accepts the options
+    gunicorn_app = main.GunicornApplication(lambda: None, options)
+    assert gunicorn_app.cfg.workers == 3
+    assert gunicorn_app.cfg.worker_class_str == "sync"
+    assert gunicorn_app.cfg.preload_app is False
+    assert gunicorn_app.cfg.post_fork is main.post_fork
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("gevent") is not None, reason="gevent is installed"
+)
+def test_gunicorn_options_gevent_missing():
+    with pytest.raises(click.BadParameter):
+        main.gunicorn_options(
+            "0.0.0.0", 8080, 3, "gevent", 1, True, 0, 0, 120, 30, None
+        )
+
+
+def test_post_fork(app, monkeypatch):
+    email_worker_apps = []
+    monkeypatch.setattr(
+        sample_flow_server.model, "start_email_worker", email_worker_apps.append
+    )
+    with app.app_context():
+        pool = db.engine.pool
+    # without preload the app is created in the worker after forking
+    main.post_fork(SimpleNamespace(app=SimpleNamespace(callable=None)), None)
+    with app.app_context():
+        assert db.engine.pool is pool
+    # with preload the forked worker gets a new connection pool
+    server = SimpleNamespace(app=SimpleNamespace(callable=app))
+    main.post_fork(server, None)
+    with app.app_context():
+        assert db.engine.pool is not pool
+    assert email_worker_apps == []
+    # and starts its own email worker
+    app.config["EMAIL_DELIVERY"] = "background"
+    main.post_fork(server, None)
+    assert email_worker_apps == [app]
+
+
+def test_app_factory(monkeypatch, tmp_path):
+    monkeypatch.setenv("JWT_SECRET_KEY", "abcdefghijklmnopqrstuvwxyz")
+    monkeypatch.setenv("EMAIL_DELIVERY", "background")
+    email_worker_apps = []
+    monkeypatch.setattr(
+        sample_flow_server.app, "start_email_worker", email_worker_apps.append
+    )
+    # with preload the email worker is not started in the master process
+    app = main.app_factory(str(tmp_path / "preload"), preload=True)()
+    assert email_worker_apps == []
+    with app.app_context():
+        db.engine.dispose()
+    app = main.app_factory(str(tmp_path / "no_preload"), preload=False)()
+    assert email_worker_apps == [app]
+    with app.app_context():
+        db.engine.dispose()
+
+
+def test_main_does_not_import_app():
+    # without preload the master process must not import the app, so that
+    # workers started after a HUP signal import the current code
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, sample_flow_server.main; "
+            "assert 'sample_flow_server.app' not in sys.modules; "
+            "assert 'sample_flow_server.model' not in sys.modules",
+        ],
+        check=True,
+    )
+
+
+def test_main_help():
+    result = CliRunner().invoke(main.main, ["--help"])
+    assert result.exit_code == 0
+    for option in [
+        "--workers",
+        "--worker-class",
+        "--threads",
+        "--preload / --no-preload",
+        "--max-requests",
+        "--graceful-timeout",
+        "--pid",
+        "--dev",
+    ]:
+        assert option in result.output
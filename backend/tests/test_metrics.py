@@ -0,0 +1,80 @@
+from __future__ import annotations
+import json
+import os
+import subprocess
+import sys
+from sample_flow_server.metrics import Metrics
+
+
+def _exited_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_metrics(tmp_path):
+    metrics = Metrics(str(tmp_path), flush_interval=60)
+    metrics.inc("sample_flow_smtp_send_failures_total")
+    metrics.inc("sample_flow_smtp_send_failures_total", 2)
+    metrics.observe("sample_flow_zip_build_duration_seconds", 0.2)
+    metrics.observe("sample_flow_zip_build_duration_seconds", 0.25)
+    metrics.observe("sample_flow_zip_build_duration_seconds", 100)
+    metrics.inc(
+        "sample_flow_http_requests_total",
+        route="/api/sample",
+        method="GET",
+        status="200",
+    )
+    text = metrics.collect()
+    assert "# TYPE sample_flow_smtp_send_failures_total counter" in text
+    assert "sample_flow_smtp_send_failures_total 3\n" in text
+    assert "# TYPE sample_flow_zip_build_duration_seconds histogram" in text
+    assert 'sample_flow_zip_build_duration_seconds_bucket{le="0.1"} 0\n' in text
+    assert 'sample_flow_zip_build_duration_seconds_bucket{le="0.25"} 2\n' in text
+    assert 'sample_flow_zip_build_duration_seconds_bucket{le="60"} 2\n' in text
+    assert 'sample_flow_zip_build_duration_seconds_bucket{le="+Inf"} 3\n' in text
+    assert "sample_flow_zip_build_duration_seconds_sum 100.45\n" in text
+    assert "sample_flow_zip_build_duration_seconds_count 3\n" in text
+    assert (
+        'sample_flow_http_requests_total{method="GET",route="/api/sample",status="200"} 1\n'
+        in text
+    )
+
+
+def test_metrics_multiple_processes(tmp_path):
+    metrics = Metrics(str(tmp_path), flush_interval=60)
+    metrics.inc("sample_flow_smtp_send_failures_total")
+    metrics.observe("sample_flow_password_verify_duration_seconds", 0.5)
+    # values written by other processes, one still running and one that has exited
+    other_values = {
+        "counters": {"sample_flow_smtp_send_failures_total": [[{}, 2]]},
+        "histograms": {
+            "sample_flow_password_verify_duration_seconds": [
+                [{}, [0] * 7 + [1] + [0] * 6 + [1.0]]
+            ]
+        },
+    }
+    running_filename = tmp_path / f"{os.getppid()}-abcd.json"
+    exited_filename = tmp_path / f"{_exited_pid()}-abcd.json"
+    for filename in [running_filename, exited_filename]:
+        with open(filename, "w") as f:
+            json.dump(other_values, f)
+    text = metrics.collect()
+    assert "sample_flow_smtp_send_failures_total 5\n" in text
+    assert "sample_flow_password_verify_duration_seconds_count 3\n" in text
+    assert "sample_flow_password_verify_duration_seconds_sum 2.5\n" in text
+    # values from the exited process are moved to the archive
+    assert running_filename.is_file()
+    assert not exited_filename.is_file()
+    assert (tmp_path / "archive.json").is_file()
+    assert metrics.collect() == text
+    # values from the current process are not lost if it is forked
+    pid = os.fork()
+    if pid == 0:
+        metrics.inc("sample_flow_smtp_send_failures_total")
+        metrics.flush()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    text = metrics.collect()
+    assert "sample_flow_smtp_send_failures_total 6\n" in text
+    assert "sample_flow_password_verify_duration_seconds_count 3\n" in text
@@ -0,0 +1,155 @@
+from __future__ import annotations
+import sample_flow_server.model as model
+import sample_flow_server.migrations as migrations
+from sample_flow_server import create_app
+import datetime
+import threading
+import sqlalchemy
+
+
+def _legacy_engine(tmp_path) -> sqlalchemy.engine.Engine:
+    return sqlalchemy.create_engine(f"sqlite:///{tmp_path}/SampleFlow.db")
+
+
+def _count(table) -> int:
+    return model.db.session.execute(
+        model.db.select(model.db.func.count()).select_from(table)
+    ).scalar_one()
+
+
+def _index_names(table_name: str):
+    return {
+        index["name"]
+        for index in model.db.inspect(model.db.engine).get_indexes(table_name)
+    }
+
+
+def test_new_db(app):
+    with app.app_context():
+        assert migrations.get_schema_version() == migrations.latest_schema_version()
+        assert _count(migrations.SchemaVersion) == 1
+        assert {
+            "ix_sample_date",
+            "ix_sample_tube_primary_key",
+            "ix_sample_email_date",
+        } <= _index_names("sample")
+
+
+def test_migrate_pickled_settings(tmp_path, monkeypatch):
+    # create a db with settings stored in the old pickled format
+    engine = _legacy_engine(tmp_path)
+    pickled_settings = sqlalchemy.Table(
+        "settings",
+        sqlalchemy.MetaData(),
+        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("datetime", sqlalchemy.DateTime, nullable=False),
+        sqlalchemy.Column("email", sqlalchemy.String(256), nullable=False),
+        sqlalchemy.Column("settings_dict", sqlalchemy.PickleType, nullable=False),
+    )
+    with engine.begin() as connection:
+        pickled_settings.create(connection)
+        for email, settings_dict in [
+            ("default", model.default_settings_dict()),
+            ("a@embl.de", {"plate_n_rows": 4, "plate_n_cols": 6}),
+        ]:
+            connection.execute(
+                sqlalchemy.insert(pickled_settings).values(
+                    datetime=datetime.datetime(2022, 11, 1),
+                    email=email,
+                    settings_dict=settings_dict,
+                )
+            )
+    engine.dispose()
+    monkeypatch.setenv("JWT_SECRET_KEY", "abcdefghijklmnopqrstuvwxyz")
+    app = create_app(data_path=str(tmp_path))
+    with app.app_context():
+        assert _count(model.Settings) == 2
+        settings = model.get_current_settings()
+        assert settings["plate_n_rows"] == 4
+        assert settings["plate_n_cols"] == 6
+        # missing keys are filled in with default values during the migration
+        default_settings = model.default_settings_dict()
+        assert settings["running_options"] == default_settings["running_options"]
+        assert (
+            settings["last_submission_day"] == default_settings["last_submission_day"]
+        )
+        latest_settings = model.db.session.execute(
+            model.db.select(model.Settings).filter(model.Settings.id == 2)
+        ).scalar_one()
+        assert latest_settings.email == "a@embl.de"
+        assert latest_settings.datetime == datetime.datetime(2022, 11, 1)
+    # the migration only happens once
+    app = create_app(data_path=str(tmp_path))
+    with app.app_context():
+        assert _count(model.Settings) == 2
+        assert model.get_current_settings() == settings
+
+
+def test_add_sample_indexes(tmp_path, monkeypatch):
+    # create a db with a sample table without indexes and no schema version
+    engine = _legacy_engine(tmp_path)
+    legacy_sample = sqlalchemy.Table(
+        "sample",
+        sqlalchemy.MetaData(),
+        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("email", sqlalchemy.String(256), nullable=False),
+        sqlalchemy.Column("primary_key", sqlalchemy.String(32), unique=True),
+        sqlalchemy.Column("tube_primary_key", sqlalchemy.String(32), nullable=False),
+        sqlalchemy.Column("name", sqlalchemy.String(128), nullable=False),
+        sqlalchemy.Column("running_option", sqlalchemy.String(128), nullable=False),
+        sqlalchemy.Column("concentration", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("date", sqlalchemy.Date, nullable=False),
+        sqlalchemy.Column("has_reference_seq_zip", sqlalchemy.Boolean, nullable=False),
+        sqlalchemy.Column("has_results_zip", sqlalchemy.Boolean, nullable=False),
+    )
+    with engine.begin() as connection:
+        legacy_sample.create(connection)
+        connection.execute(
+            sqlalchemy.insert(legacy_sample).values(
+                email="user@embl.de",
+                primary_key="22_46_A1",
+                tube_primary_key="22_46_A1",
+                name="legacy",
+                running_option="r",
+                concentration=1,
+                date=datetime.date(2022, 11, 14),
+                has_reference_seq_zip=False,
+                has_results_zip=False,
+            )
+        )
+    assert "ix_sample_date" not in {
+        index["name"] for index in sqlalchemy.inspect(engine).get_indexes("sample")
+    }
+    engine.dispose()
+    monkeypatch.setenv("JWT_SECRET_KEY", "abcdefghijklmnopqrstuvwxyz")
+    app = create_app(data_path=str(tmp_path))
+    with app.app_context():
+        assert migrations.get_schema_version() == migrations.latest_schema_version()
+        assert {
+            "ix_sample_date",
+            "ix_sample_tube_primary_key",
+            "ix_sample_email_date",
+        } <= _index_names("sample")
+        # existing data is unchanged and missing tables are created
+        assert _count(model.Sample) == 1
+        assert _count(model.User) == 0
+        assert model.db.inspect(model.db.engine).has_table("well_allocation")
+
+
+def test_upgrade_db_lock(app):
+    # upgrade_db waits while another process is upgrading the db
+    upgraded = threading.Event()
+
+    def upgrade():
+        with app.app_context():
+            migrations.upgrade_db()
+        upgraded.set()
+
+    with app.app_context():
+        with migrations.migration_lock():
+            thread = threading.Thread(target=upgrade)
+            thread.start()
+            assert not upgraded.wait(timeout=0.5)
+        assert upgraded.wait(timeout=10)
+        thread.join()
+        assert _count(migrations.SchemaVersion) == 1
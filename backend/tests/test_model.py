@@ -1,11 +1,21 @@
 from __future__ import annotations
 import sample_flow_server.model as model
 import datetime
+import os
 import shutil
+import io
+import fcntl
+import zipfile
+import math
 import pathlib
 from freezegun import freeze_time
 from werkzeug.datastructures import FileStorage
+from sample_flow_server.mail import CircuitBreaker
 import secrets
+import sqlalchemy
+import sqlite3
+import threading
+import time
 
 
 def _count_settings() -> int:
@@ -57,6 +67,85 @@ def test_settings(app, tmp_path):
         assert new_settings["last_submission_day"] == 5
 
 
+def test_settings_invalid(app):
+    with app.app_context():
+        settings = model.get_current_settings()
+        n_settings = _count_settings()
+        for key, value in [
+            ("plate_n_rows", 0),
+            ("plate_n_rows", 27),
+            ("plate_n_rows", "8"),
+            ("plate_n_cols", True),
+            ("last_submission_day", 8),
+            ("running_options", "option"),
+            ("running_options", ["option", 3]),
+        ]:
+            invalid_settings = dict(settings)
+            invalid_settings[key] = value
+            msg, code = model.set_current_settings("a@embl.de", invalid_settings)
+            assert code == 400
+            assert key in msg
+            assert "settings not updated" in msg
+        assert _count_settings() == n_settings
+        assert model.get_current_settings() == settings
+
+
+def test_settings_cache(app, tmp_path):
+    queries = []
+
+    def _count_queries(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    with app.app_context():
+        settings = model.get_current_settings()
+        assert model._settings_cache[str(tmp_path)][0] == 1
+        assert model._read_settings_version() == 1
+        # modifying the returned dict doesn't modify the cached settings
+        settings["plate_n_rows"] = 3
+        assert model.get_current_settings()["plate_n_rows"] == 8
+        # the cached settings are used without querying the db
+        sqlalchemy.event.listen(
+            model.db.engine, "before_cursor_execute", _count_queries
+        )
+        assert model.get_current_settings()["plate_n_rows"] == 8
+        assert queries == []
+        sqlalchemy.event.remove(
+            model.db.engine, "before_cursor_execute", _count_queries
+        )
+        model._settings_cache[str(tmp_path)] = (1, {"plate_n_rows": 7}, math.inf)
+        assert model.get_current_settings()["plate_n_rows"] == 7
+        # settings added to the db by another host are used once the cache expires
+        model.db.session.add(
+            model.Settings(
+                datetime=datetime.datetime.today(),
+                email="direct",
+                **settings,
+            )
+        )
+        model.db.session.commit()
+        assert model.get_current_settings()["plate_n_rows"] == 7
+        model._settings_cache[str(tmp_path)] = (1, {"plate_n_rows": 7}, 0.0)
+        assert model.get_current_settings()["plate_n_rows"] == 3
+        assert model._settings_cache[str(tmp_path)][0] == 2
+        assert model._read_settings_version() == 2
+        # set_current_settings updates the cache and the version file
+        settings["plate_n_rows"] = 5
+        msg, code = model.set_current_settings("a@embl.de", settings)
+        assert code == 200
+        assert model._settings_cache[str(tmp_path)][0] == 3
+        assert model._read_settings_version() == 3
+        assert model.get_current_settings()["plate_n_rows"] == 5
+        # settings changed by another process on this host invalidate the cache
+        model._settings_cache[str(tmp_path)] = (2, {"plate_n_rows": 7}, math.inf)
+        assert model.get_current_settings()["plate_n_rows"] == 5
+        # an older version never replaces a newer one
+        model._write_settings_version(2)
+        assert model._read_settings_version() == 3
+        # a different process with an empty cache reads the current settings from the db
+        model._settings_cache.clear()
+        assert model.get_current_settings()["plate_n_rows"] == 5
+
+
 @freeze_time("2022-11-21")
 def test_add_new_sample_mon(app, tmp_path):
     with app.app_context():
@@ -155,6 +244,139 @@ def test_add_new_sample_full(app, tmp_path):
         assert "samples have been taken this week" in error_message
 
 
+@freeze_time("2022-11-21")
+def test_blob_store(app, tmp_path, result_zipfile):
+    with app.app_context():
+        samples = []
+        for name in ["s1", "s2"]:
+            new_sample, _ = model.add_new_sample(
+                "u1@embl.de",
+                name,
+                "running option",
+                234,
+                [FileStorage(io.BytesIO(b">ref\nACGT"), "ref.fa")],
+            )
+            samples.append(new_sample)
+        # identical reference sequences are stored once
+        ref_paths = [pathlib.Path(s.reference_seq_zip_path()) for s in samples]
+        assert ref_paths[0].read_bytes() == ref_paths[1].read_bytes()
+        assert ref_paths[0].stat().st_ino == ref_paths[1].stat().st_ino
+        blobs = [p for p in (tmp_path / "blobs").glob("??/*")]
+        assert len(blobs) == 1
+        assert blobs[0].name == model._file_sha256(ref_paths[0])
+        assert blobs[0].stat().st_ino == ref_paths[0].stat().st_ino
+        # resubmitted sample links to the same file
+        message, code = model.resubmit_sample(samples[0].primary_key)
+        assert code == 200
+        resubmitted_path = tmp_path / "2022/47/inputs/references/22_47_A3_s1.zip"
+        assert resubmitted_path.stat().st_ino == ref_paths[0].stat().st_ino
+        # identical results are stored once
+        for sample in samples:
+            with open(result_zipfile, "rb") as f:
+                model.process_result(sample.primary_key, True, FileStorage(f))
+        result_paths = [pathlib.Path(s.results_file_path()) for s in samples]
+        assert result_paths[0].stat().st_ino == result_paths[1].stat().st_ino
+        # a new result replaces the link instead of modifying the shared file
+        with open(result_zipfile, "rb") as f:
+            result_zipfile_bytes = f.read()
+        model.process_result(
+            samples[0].primary_key,
+            True,
+            FileStorage(io.BytesIO(b"new" + result_zipfile_bytes)),
+        )
+        assert result_paths[0].read_bytes() == b"new" + result_zipfile_bytes
+        assert result_paths[1].read_bytes() == result_zipfile_bytes
+        assert list((tmp_path / "blobs" / "tmp").iterdir()) == []
+        # blobs that are still linked are kept
+        assert model.remove_unused_blobs() == {"blobs": 0, "tmp_files": 0, "bytes": 0}
+        assert len(list((tmp_path / "blobs").glob("??/*"))) == 3
+        # removing the last link to a blob allows it to be removed
+        old_result_blob = (
+            tmp_path / "blobs" / model._file_sha256(result_paths[1])[:2]
+        ) / model._file_sha256(result_paths[1])
+        result_paths[1].unlink()
+        # temporary files are removed once they are older than BLOB_TMP_EXPIRY
+        old_tmp_file = model._new_blob_tmp_path()
+        old_tmp_file.write_bytes(b"old")
+        expired = time.time() - model.BLOB_TMP_EXPIRY.total_seconds() - 1
+        os.utime(old_tmp_file, (expired, expired))
+        new_tmp_file = model._new_blob_tmp_path()
+        new_tmp_file.write_bytes(b"new")
+        assert model.remove_unused_blobs() == {
+            "blobs": 1,
+            "tmp_files": 1,
+            "bytes": len(result_zipfile_bytes) + 3,
+        }
+        assert not old_result_blob.exists()
+        assert not old_tmp_file.exists()
+        assert new_tmp_file.exists()
+        assert len(list((tmp_path / "blobs").glob("??/*"))) == 2
+        assert result_paths[0].read_bytes() == b"new" + result_zipfile_bytes
+        assert ref_paths[0].read_bytes() == ref_paths[1].read_bytes()
+
+
+@freeze_time("2022-11-21")
+def test_get_new_key_concurrent(app):
+    with app.app_context():
+        current_date = datetime.date.today()
+        settings = model.get_current_settings()
+        settings["plate_n_rows"] = 1
+        settings["plate_n_cols"] = 2
+        model.set_current_settings("a@embl.de", settings)
+        # two requests that see the same sample count get different wells
+        key1, message = model._get_new_key(current_date)
+        assert key1 == "22_47_A1"
+        assert model._count_samples_this_week(current_date) == 0
+        key2, message = model._get_new_key(current_date)
+        assert key2 == "22_47_A2"
+        # all wells are reserved
+        key3, message = model._get_new_key(current_date)
+        assert key3 is None
+        assert "samples have been taken this week" in message
+        wells = model.db.session.execute(
+            model.db.select(model.WellAllocation.well).filter_by(year=2022, week=47)
+        ).scalars()
+        assert sorted(wells) == ["A1", "A2"]
+
+
+def test_update_samples_zipfile(app, tmp_path):
+    current_date = datetime.date(2022, 11, 16)
+    inputs_dir = tmp_path / "2022/46/inputs"
+    with app.app_context():
+        zip_filename = model.update_samples_zipfile(current_date)
+        assert zip_filename == f"{tmp_path}/2022/46/samples.zip"
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            assert len(zip_file.namelist()) == 6
+            assert zip_file.read("samples.tsv").decode().count("\n") == 5
+            reference = zip_file.getinfo("references/22_46_A1_ref_seq.zip")
+            assert reference.compress_type == zipfile.ZIP_STORED
+            tsv = zip_file.getinfo("samples.tsv")
+            assert tsv.compress_type == zipfile.ZIP_DEFLATED
+        # nothing changed: existing zip file is re-used
+        inode = pathlib.Path(zip_filename).stat().st_ino
+        assert model.update_samples_zipfile(current_date) == zip_filename
+        assert pathlib.Path(zip_filename).stat().st_ino == inode
+        # new reference file: zip file is updated
+        shutil.copy(
+            inputs_dir / "references/22_46_A1_ref_seq.zip",
+            inputs_dir / "references/22_46_A5_new.zip",
+        )
+        assert model.update_samples_zipfile(current_date) == zip_filename
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            assert len(zip_file.namelist()) == 7
+            assert "references/22_46_A5_new.zip" in zip_file.namelist()
+        # sample removed: tsv and zip file are updated
+        model.db.session.delete(
+            model.db.session.execute(
+                model.db.select(model.Sample).filter_by(primary_key="22_46_A4")
+            ).scalar_one()
+        )
+        model.db.session.commit()
+        model.update_samples_zipfile(current_date)
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            assert zip_file.read("samples.tsv").decode().count("\n") == 4
+
+
 def _count_users() -> int:
     return len(model.db.session.execute(model.db.select(model.User)).scalars().all())
 
@@ -250,6 +472,47 @@ def test_process_result_success(app, result_zipfile, tmp_path):
         assert len(email_attachments) == 2
 
 
+def test_process_result_email_attachments(app, tmp_path, monkeypatch):
+    primary_key = "22_46_A1"
+    zip_path = tmp_path / "result.zip"
+    with zipfile.ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("email.txt", "dir/b.txt\nmissing.txt\n")
+        zip_file.writestr("dir/b.txt", "contents of b")
+    # attachments should be read from the zip file without extracting anything
+    monkeypatch.setattr(model.tempfile, "TemporaryDirectory", None)
+    with app.app_context():
+        with open(zip_path, "rb") as f:
+            message, code = model.process_result(primary_key, True, FileStorage(f))
+        assert code == 200
+        last_email_msg = app.config.get("TESTING_ONLY_LAST_SMTP_MESSAGE")
+        attachments = list(last_email_msg.iter_attachments())
+        assert len(attachments) == 1
+        assert attachments[0].get_filename() == "b.txt"
+        assert attachments[0].get_content() == b"contents of b"
+
+
+def test_process_result_email_attachments_max_size(app, tmp_path):
+    primary_key = "22_46_A1"
+    zip_path = tmp_path / "result.zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("email.txt", "a.txt\nlarge.txt\nc.txt\n")
+        zip_file.writestr("a.txt", "a" * 600)
+        # compresses well, but is too large to attach when uncompressed
+        zip_file.writestr("large.txt", "x" * 1000)
+        zip_file.writestr("c.txt", "c" * 300)
+    app.config["EMAIL_MAX_ATTACHMENTS_SIZE"] = 1000
+    with app.app_context():
+        with open(zip_path, "rb") as f:
+            message, code = model.process_result(primary_key, True, FileStorage(f))
+        assert code == 200
+        last_email_msg = app.config.get("TESTING_ONLY_LAST_SMTP_MESSAGE")
+        attachments = list(last_email_msg.iter_attachments())
+        assert [a.get_filename() for a in attachments] == ["a.txt", "c.txt"]
+        body = str(last_email_msg.get_body()).replace("=\n", "")
+        assert "too large to attach" in body
+        assert "large.txt" in body
+
+
 def test_process_result_unsuccessful(app):
     with app.app_context():
         last_email_msg = app.config.get("TESTING_ONLY_LAST_SMTP_MESSAGE")
@@ -324,3 +587,243 @@ def test_reset_password(app):
         assert user is not None
         assert user.email == email
         assert user.check_password(new_password) is True
+
+
+def _outbox_emails():
+    return (
+        model.db.session.execute(
+            model.db.select(model.OutboxEmail).order_by(model.OutboxEmail.id)
+        )
+        .scalars()
+        .all()
+    )
+
+
+def test_email_outbox_retry(app, local_smtp):
+    app.config["EMAIL_DELIVERY"] = "background"
+    with app.app_context():
+        with freeze_time("2022-11-21 09:00:00") as frozen_time:
+            model.send_password_reset_email("user@embl.de")
+            # email is in the outbox but not yet sent
+            (outbox_email,) = _outbox_emails()
+            assert outbox_email.recipient == "user@embl.de"
+            assert outbox_email.subject == "SampleFlow password reset"
+            assert len(local_smtp.sent_messages) == 0
+            # sending fails: email is retried later
+            local_smtp.failures_remaining = 1
+            assert model.deliver_pending_emails() == 0
+            assert outbox_email.attempts == 1
+            assert "stand-in failure" in outbox_email.last_error
+            assert outbox_email.next_attempt == datetime.datetime(2022, 11, 21, 9, 1)
+            frozen_time.tick(30)
+            assert model.deliver_pending_emails() == 0
+            frozen_time.tick(30)
+            assert model.deliver_pending_emails() == 1
+            assert len(local_smtp.sent_messages) == 1
+            # sent emails are deleted from the outbox
+            assert _outbox_emails() == []
+            assert local_smtp.sent_messages[0]["To"] == "user@embl.de"
+            # sent emails are not sent again
+            assert model.deliver_pending_emails() == 0
+            assert len(local_smtp.sent_messages) == 1
+
+
+def test_email_outbox_reuses_connection(app, local_smtp):
+    app.config["EMAIL_DELIVERY"] = "background"
+    with app.app_context():
+        for email in ["a@embl.de", "b@embl.de", "c@embl.de"]:
+            model.send_password_reset_email(email)
+        assert len(_outbox_emails()) == 3
+        assert model.deliver_pending_emails() == 3
+        assert local_smtp.connections == 1
+        assert [msg["To"] for msg in local_smtp.sent_messages] == [
+            "a@embl.de",
+            "b@embl.de",
+            "c@embl.de",
+        ]
+
+
+def test_email_outbox_claimed(app, local_smtp):
+    app.config["EMAIL_DELIVERY"] = "background"
+    with app.app_context():
+        model.send_password_reset_email("user@embl.de")
+        (outbox_email,) = _outbox_emails()
+        # email claimed by another worker is not sent
+        assert model._claim_email(outbox_email.id, datetime.datetime.today())
+        assert model.deliver_pending_emails() == 0
+        assert len(local_smtp.sent_messages) == 0
+
+
+def test_email_worker(app, local_smtp):
+    app.config["EMAIL_DELIVERY"] = "background"
+    stop_email_worker = model.start_email_worker(app, interval=0.1)
+    assert stop_email_worker is not None
+    # only one worker per process
+    assert model.start_email_worker(app) is None
+    try:
+        with app.app_context():
+            model.send_password_reset_email("user@embl.de")
+        for _ in range(100):
+            if len(local_smtp.sent_messages) > 0:
+                break
+            time.sleep(0.05)
+        assert len(local_smtp.sent_messages) == 1
+        assert local_smtp.sent_messages[0]["To"] == "user@embl.de"
+    finally:
+        stop_email_worker.set()
+
+
+def test_email_outbox_circuit_open(app, local_smtp):
+    app.config["EMAIL_DELIVERY"] = "background"
+    app.extensions["email_circuit_breaker"] = CircuitBreaker("email", 2, 60)
+    with app.app_context():
+        for email in ["a@embl.de", "b@embl.de", "c@embl.de", "d@embl.de"]:
+            model.send_password_reset_email(email)
+        local_smtp.failures_remaining = 2
+        assert model.deliver_pending_emails() == 0
+        status = model.email_status()
+        assert status["circuit_breaker"]["state"] == "open"
+        assert status["circuit_breaker"]["degraded"] is True
+        assert status["pending_emails"] == 4
+        assert status["failed_emails"] == 0
+        # emails not attempted while the circuit is open keep their attempt count
+        attempts = [outbox_email.attempts for outbox_email in _outbox_emails()]
+        assert attempts == [1, 1, 0, 0]
+        assert local_smtp.connections == 2
+
+
+def test_email_outbox_failed_retention(app, local_smtp):
+    app.config["EMAIL_DELIVERY"] = "background"
+    with app.app_context():
+        with freeze_time("2022-11-21 09:00:00") as frozen_time:
+            model.send_password_reset_email("user@embl.de")
+            (outbox_email,) = _outbox_emails()
+            outbox_email.attempts = model.EMAIL_MAX_ATTEMPTS
+            model.db.session.commit()
+            # failed emails are kept for a while
+            frozen_time.tick(datetime.timedelta(days=29))
+            assert model.deliver_pending_emails() == 0
+            assert model.email_status()["failed_emails"] == 1
+            # and then deleted
+            frozen_time.tick(datetime.timedelta(days=2))
+            assert model.deliver_pending_emails() == 0
+            assert model.email_status()["failed_emails"] == 0
+            assert _outbox_emails() == []
+            assert len(local_smtp.sent_messages) == 0
+
+
+class _InterruptedStream(io.BytesIO):
+    def read(self, size=-1):
+        data = super().read(min(size, 3))
+        if not data:
+            raise ConnectionResetError("client disconnected")
+        return data
+
+
+def test_append_to_upload_interrupted(app):
+    with app.app_context():
+        upload, message = model.create_upload("user@embl.de", "a.fa", 10, 100)
+        assert upload is not None
+        message, code = model.append_to_upload(upload, 0, _InterruptedStream(b"12345"))
+        assert code == 400
+        # data received before the interruption is kept
+        assert upload.offset == 5
+        assert upload.file_path().read_bytes() == b"12345"
+        message, code = model.append_to_upload(upload, 5, io.BytesIO(b"67890"))
+        assert code == 200
+        assert upload.is_complete()
+        uploaded_file = model.get_uploaded_file(upload.id, "user@embl.de")
+        assert uploaded_file is not None
+        assert model.get_uploaded_file(upload.id, "admin@embl.de") is None
+
+
+def test_remove_expired_uploads(app):
+    with app.app_context():
+        with freeze_time("2022-11-21"):
+            upload, _ = model.create_upload("user@embl.de", "a.fa", 10, 100)
+            active_upload, _ = model.create_upload("user@embl.de", "b.fa", 10, 100)
+            locked_upload, _ = model.create_upload("user@embl.de", "c.fa", 10, 100)
+        upload_path = upload.file_path()
+        assert upload_path.is_file()
+        # appending to an upload keeps it from expiring
+        with freeze_time("2022-11-22 12:00:00"):
+            message, code = model.append_to_upload(
+                active_upload, 0, io.BytesIO(b"01234")
+            )
+            assert code == 200
+        with freeze_time("2022-11-23"):
+            with open(locked_upload.file_path(), "r+b") as f:
+                # an upload that is being appended to is not removed
+                fcntl.flock(f, fcntl.LOCK_EX)
+                model.create_upload("user@embl.de", "d.fa", 10, 100)
+        assert not upload_path.is_file()
+        assert model.get_upload(upload.id, "user@embl.de") is None
+        assert active_upload.file_path().is_file()
+        assert model.get_upload(active_upload.id, "user@embl.de") is not None
+        assert locked_upload.file_path().is_file()
+        assert model.get_upload(locked_upload.id, "user@embl.de") is not None
+
+
+def test_get_user_cache(app):
+    queries = []
+
+    def _count_queries(conn, cursor, statement, *args):
+        if statement.lstrip().startswith("SELECT"):
+            queries.append(statement)
+
+    with app.app_context():
+        user_cache = app.extensions["user_cache"]
+        user_id = model.db.session.execute(
+            model.db.select(model.User.id).filter_by(email="user@embl.de")
+        ).scalar_one()
+        sqlalchemy.event.listen(
+            model.db.engine, "before_cursor_execute", _count_queries
+        )
+    # first lookup queries the db, later lookups use the cache
+    for n_queries in [1, 1, 1]:
+        with app.app_context():
+            user = model.get_user(user_id)
+            assert user.email == "user@embl.de"
+            assert user.is_admin is False
+            assert len(queries) == n_queries
+    assert user_cache.get(user_id)["email"] == "user@embl.de"
+    assert "password_hash" not in user_cache.get(user_id)
+    # cached user can be modified
+    with app.app_context():
+        user = model.get_user(user_id)
+        user.set_password_nocheck("newPassword1")
+        assert user_cache.get(user_id) is None
+        assert model.get_user(user_id).check_password("newPassword1")
+    with app.app_context():
+        user = model.get_user(user_id)
+        assert user.check_password("newPassword1")
+        user.is_admin = True
+        model.db.session.commit()
+        assert user_cache.get(user_id) is None
+    with app.app_context():
+        assert model.get_user(user_id).is_admin is True
+        sqlalchemy.event.remove(
+            model.db.engine, "before_cursor_execute", _count_queries
+        )
+
+
+def test_set_sqlite_pragmas_waits_for_lock(tmp_path):
+    db_path = tmp_path / "pragmas.db"
+    other = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    other.execute("CREATE TABLE t (x INTEGER)")
+    # another connection holds a write lock while a new connection switches to WAL
+    other.execute("BEGIN EXCLUSIVE")
+    threading.Timer(0.2, other.execute, ["COMMIT"]).start()
+    # without the driver's own default timeout, so that only busy_timeout applies
+    engine = sqlalchemy.create_engine(
+        f"sqlite:///{db_path}", connect_args={"timeout": 0}
+    )
+    model.set_sqlite_pragmas(
+        engine, {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000}
+    )
+    with engine.connect() as connection:
+        assert (
+            connection.execute(sqlalchemy.text("PRAGMA journal_mode")).scalar() == "wal"
+        )
+    engine.dispose()
+    other.close()
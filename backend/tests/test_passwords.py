@@ -0,0 +1,71 @@
+from __future__ import annotations
+import threading
+import time
+import pytest
+from sample_flow_server.passwords import PasswordHasherPool, PasswordHasherBusyError
+
+
+def test_password_hasher_pool():
+    pool = PasswordHasherPool(max_workers=2, max_queued=2, timeout=10)
+    password_hash = pool.hash("abc")
+    assert pool.verify(password_hash, "abc") is True
+    assert pool.verify(password_hash, "wrong") is False
+    assert pool.check_needs_rehash(password_hash) is False
+    assert pool.status() == {
+        "max_workers": 2,
+        "max_queued": 2,
+        "in_progress": 0,
+        "rejected": 0,
+    }
+
+
+def _wait_for(condition) -> None:
+    for _ in range(100):
+        if condition():
+            return
+        time.sleep(0.05)
+
+
+def test_password_hasher_pool_queue_full():
+    pool = PasswordHasherPool(max_workers=1, max_queued=1, timeout=10)
+    unblock = threading.Event()
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda n=n: results.append(pool._run(lambda: unblock.wait() and n))
+        )
+        for n in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    # one request running, one queued
+    _wait_for(lambda: pool.status()["in_progress"] == 2)
+    assert pool.status()["in_progress"] == 2
+    # queue full: request is rejected immediately
+    with pytest.raises(PasswordHasherBusyError):
+        pool.hash("abc")
+    assert pool.status()["rejected"] == 1
+    unblock.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [0, 1]
+    assert pool.status()["in_progress"] == 0
+    # pool can be used again
+    assert pool.verify(pool.hash("abc"), "abc") is True
+
+
+def test_password_hasher_pool_timeout():
+    pool = PasswordHasherPool(max_workers=1, max_queued=1, timeout=0.1)
+    unblock = threading.Event()
+    # running request times out
+    with pytest.raises(PasswordHasherBusyError):
+        pool._run(unblock.wait)
+    assert pool.status()["in_progress"] == 1
+    # queued request times out and is removed from the queue
+    with pytest.raises(PasswordHasherBusyError):
+        pool.hash("abc")
+    assert pool.status()["in_progress"] == 1
+    assert pool.status()["rejected"] == 2
+    unblock.set()
+    _wait_for(lambda: pool.status()["in_progress"] == 0)
+    assert pool.status()["in_progress"] == 0
@@ -7,6 +7,8 @@ from sample_flow_server.utils import (
     decode_password_reset_token,
 )
 from sample_flow_server.utils import encode_activation_token, decode_activation_token
+from sample_flow_server.utils import encode_download_token, decode_download_token
+from freezegun import freeze_time
 
 
 def test_get_start_of_week():
@@ -67,3 +69,16 @@ def test_activation_token():
     assert decoded_email is None
     decoded_email = decode_activation_token("invalid-token", secret)
     assert decoded_email is None
+
+
+def test_download_token():
+    path = "2022/46/results/22_46_A1_ref_seq.zip"
+    secret = "p23c5fn78nd"
+    with freeze_time("2022-11-21 12:00:00"):
+        token = encode_download_token(path, secret)
+    with freeze_time("2022-11-21 12:04:00"):
+        assert decode_download_token(token, secret, 300) == path
+        assert decode_download_token(token, "wrong secret", 300) is None
+        assert decode_download_token("invalid-token", secret, 300) is None
+    with freeze_time("2022-11-21 12:06:00"):
+        assert decode_download_token(token, secret, 300) is None
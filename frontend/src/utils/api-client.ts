@@ -32,6 +32,27 @@ function download_file_from_endpoint(
       link.setAttribute("download", filename);
       document.body.appendChild(link);
       link.click();
+      link.remove();
+      window.URL.revokeObjectURL(url);
+    })
+    .catch((error) => {
+      if (error.response.status > 400) {
+        logout();
+      }
+    });
+}
+
+// the browser downloads the file directly from a short-lived signed url
+function download_file_from_url(url: string) {
+  apiClient
+    .get(`${url}/download_url`)
+    .then((response) => {
+      const link = document.createElement("a");
+      link.href = new URL(response.data.url, apiClient.defaults.baseURL).href;
+      link.setAttribute("download", "");
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
     })
     .catch((error) => {
       if (error.response.status > 400) {
@@ -41,19 +62,11 @@ function download_file_from_endpoint(
 }
 
 function download_reference_sequence(primary_key: string) {
-  download_file_from_endpoint(
-    "reference_sequence",
-    { primary_key: primary_key },
-    `${primary_key}_reference_sequence.zip`
-  );
+  download_file_from_url(`reference_sequence/${primary_key}`);
 }
 
 function download_result(primary_key: string) {
-  download_file_from_endpoint(
-    "result",
-    { primary_key: primary_key },
-    `${primary_key}.zip`
-  );
+  download_file_from_url(`result/${primary_key}`);
 }
 
 function download_zipsamples() {